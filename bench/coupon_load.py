@@ -0,0 +1,128 @@
+"""Latenza di /save + /list mentre /coupon aspetta un upstream lento.
+
+    python bench/coupon_load.py                 # stub a 4 s, 2 worker x 4 thread, 30 client
+    python bench/coupon_load.py --delay 8 --clients 50
+
+Avvia coupon_stub.py e gunicorn (gunicorn.conf.py del repo, dati in una cartella
+temporanea, PM_COUPON_URL verso lo stub, TTL e stale a 0 così ogni ?refresh=1 va
+all'upstream), misura la prenotazione a vuoto e poi con i client coupon attivi.
+"""
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PASSCODE = "melograno"
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_up(url: str, timeout: float = 20):
+    end = time.time() + timeout
+    while time.time() < end:
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise SystemExit(f"{url} non risponde")
+
+
+def booking_latency(base: str, s, d: str, rounds: int):
+    out = []
+    for _ in range(rounds):
+        t = time.perf_counter()
+        s.post(base + "/save", data={"date": d, "status": "presence"}, timeout=120)
+        s.get(base + "/list", params={"date": d}, timeout=120)
+        out.append(time.perf_counter() - t)
+        time.sleep(0.2)
+    return out
+
+
+def coupon_client(base: str, stop, codes: dict, lock):
+    s = requests.Session()
+    while not stop.is_set():
+        try:
+            code = s.get(base + "/coupon?refresh=1", timeout=60).status_code
+        except requests.RequestException:
+            code = "errore"
+        with lock:
+            codes[code] = codes.get(code, 0) + 1
+        time.sleep(0.2)
+
+
+def report(label: str, values):
+    print(f"save+list {label:<12} mediana {statistics.median(values) * 1000:7.0f} ms"
+          f"   max {max(values) * 1000:7.0f} ms")
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--delay", type=float, default=4.0, help="secondi di risposta dello stub")
+    ap.add_argument("--clients", type=int, default=30, help="client su /coupon?refresh=1")
+    ap.add_argument("--workers", type=int, default=2)
+    ap.add_argument("--threads", type=int, default=4)
+    ap.add_argument("--rounds", type=int, default=8, help="save+list misurati per fase")
+    args = ap.parse_args()
+
+    stub_port, app_port = free_port(), free_port()
+    base = f"http://127.0.0.1:{app_port}"
+    env = dict(os.environ,
+               PM_COUPON_URL=f"http://127.0.0.1:{stub_port}/",
+               PM_COUPON_TTL="0", PM_COUPON_STALE="0",
+               PM_BIND=f"127.0.0.1:{app_port}",
+               PM_WORKERS=str(args.workers), PM_THREADS=str(args.threads),
+               PM_LOG_LEVEL="warning")
+    procs = []
+    with tempfile.TemporaryDirectory(prefix="pm-bench-") as workdir:
+        os.mkdir(os.path.join(workdir, "data"))
+        try:
+            procs.append(subprocess.Popen(
+                [sys.executable, os.path.join(ROOT, "bench", "coupon_stub.py"), str(stub_port), str(args.delay)]))
+            procs.append(subprocess.Popen(
+                [sys.executable, "-m", "gunicorn", "-c", os.path.join(ROOT, "gunicorn.conf.py"),
+                 "--chdir", workdir, "--pythonpath", ROOT, "--access-logfile", os.devnull, "server:app"],
+                env=env))
+            wait_up(base + "/")
+
+            # login prima del carico: la sessione (e la sua connessione) serve a entrambe le fasi
+            s = requests.Session()
+            s.post(base + "/login", data={"name": "bench", "pass": PASSCODE})
+            d = s.get(base + "/dashboard", timeout=60).json()["days"][0]["date"]
+            idle = booking_latency(base, s, d, args.rounds)
+            codes, lock, stop = {}, threading.Lock(), threading.Event()
+            clients = [threading.Thread(target=coupon_client, args=(base, stop, codes, lock), daemon=True)
+                       for _ in range(args.clients)]
+            for t in clients:
+                t.start()
+            time.sleep(1)
+            loaded = booking_latency(base, s, d, args.rounds)
+            stop.set()
+            for t in clients:
+                t.join(args.delay + 60)
+
+            print(f"upstream {args.delay:g} s, {args.workers} worker x {args.threads} thread, "
+                  f"{args.clients} client coupon")
+            report("a vuoto", idle)
+            report("con coupon", loaded)
+            print("risposte /coupon:", dict(sorted(codes.items(), key=str)))
+        finally:
+            for p in reversed(procs):
+                p.terminate()
+                p.wait(10)
+
+
+if __name__ == "__main__":
+    main()
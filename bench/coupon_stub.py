@@ -0,0 +1,39 @@
+"""Upstream finto per /coupon: risponde con una pagina promo valida dopo `delay` secondi.
+
+    python bench/coupon_stub.py 8990 4      # porta, ritardo in secondi
+
+Usato da bench/coupon_load.py tramite PM_COUPON_URL=http://127.0.0.1:<porta>/.
+"""
+import http.server
+import socketserver
+import sys
+import time
+
+PAGE = (
+    b'<div class="img-container"><img alt="promowe_bench"></div>'
+    b'<div class="condizioni-box"><strong>Acquista entro le ore 18.00 del 22.09.2030.</strong></div>'
+)
+
+
+class _Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+def serve(port: int, delay: float):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(delay)
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(PAGE)))
+            self.end_headers()
+            self.wfile.write(PAGE)
+
+        def log_message(self, *args):
+            pass
+
+    _Server(("127.0.0.1", port), Handler).serve_forever()
+
+
+if __name__ == "__main__":
+    serve(int(sys.argv[1]), float(sys.argv[2]) if len(sys.argv) > 2 else 4.0)
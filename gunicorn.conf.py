@@ -0,0 +1,23 @@
+# Avvio in produzione: gunicorn -c gunicorn.conf.py server:app
+# (python server.py resta il server di sviluppo, con reloader e debugger)
+import multiprocessing
+import os
+
+# prima del preload di server.py: lock su file e change log condiviso tra i worker
+os.environ.setdefault("PM_MULTIPROCESS", "1")
+
+bind = os.environ.get("PM_BIND", "0.0.0.0:5001")
+workers = int(os.environ.get("PM_WORKERS", min(4, multiprocessing.cpu_count() * 2)))
+worker_class = "gthread"
+threads = int(os.environ.get("PM_THREADS", "8"))
+# /events (SSE) tiene occupato un thread per client collegato: al più metà dei thread,
+# oltre il server risponde 503 e la pagina aggiorna con il polling
+os.environ.setdefault("PM_SSE_MAX", str(threads // 2))
+# l'app viene importata una volta nel master e poi forkata nei worker
+preload_app = True
+timeout = int(os.environ.get("PM_TIMEOUT", "60"))
+graceful_timeout = int(os.environ.get("PM_GRACEFUL_TIMEOUT", "30"))
+keepalive = 5
+accesslog = "-"
+errorlog = "-"
+loglevel = os.environ.get("PM_LOG_LEVEL", "info")
@@ -1,15 +1,33 @@
-from flask import Blueprint, render_template
+from flask import Blueprint, render_template, request
+import os, threading, time, logging
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
 from bs4 import BeautifulSoup
 from datetime import date, timedelta, datetime
 
 bp_coupon = Blueprint("coupon", __name__)
+log = logging.getLogger(__name__)
+
+# ================== CONFIG ==================
+# URL sovrascrivibile per puntare a uno stub locale nei test
+COUPON_URL       = os.environ.get("PM_COUPON_URL", "https://www.italotreno.com/it/promo-week")
+COUPON_TIMEOUT   = 10                                             # secondi per la GET upstream
+COUPON_TTL       = int(os.environ.get("PM_COUPON_TTL", "900"))     # risultato "fresco"
+COUPON_STALE_MAX = int(os.environ.get("PM_COUPON_STALE", "86400")) # oltre, si aspetta il nuovo fetch
+COUPON_POOL      = 4                                              # connessioni tenute aperte verso upstream
+COUPON_FAILURES  = 3                                              # errori di fila che aprono il circuito
+COUPON_COOLDOWN  = 60                                             # secondi a circuito aperto prima di riprovare
+# le GET upstream girano su un thread dedicato, non su quelli che servono le richieste:
+# al più COUPON_WAITING richieste per worker restano ad aspettarle (per COUPON_WAIT
+# secondi), le altre ricevono subito un 503 e /save e /list restano liberi
+COUPON_WAITING   = int(os.environ.get("PM_COUPON_WAITING", "2"))
+COUPON_WAIT      = COUPON_TIMEOUT
 
-@bp_coupon.route("/coupon")
-def coupon():
-    url = "https://www.italotreno.com/it/promo-week"
-    r = requests.get(url, timeout=10)
-    soup = BeautifulSoup(r.text, "html.parser")
+
+def parse_coupon(html: str):
+    """Nome coupon e scadenza dalla pagina promo (la parte costosa: BeautifulSoup)."""
+    soup = BeautifulSoup(html, "html.parser")
 
     # estrai nome coupon dall'immagine promo
     img = soup.select_one(".img-container img")
@@ -35,18 +53,248 @@ def coupon():
         except Exception:
             pass
 
-    # genera martedì fino a expiry_date
+    return {
+        "coupon_name": coupon_name,
+        "expiry": expiry,
+        "expiry_date": expiry_date,
+        "fetched_at": datetime.now().strftime("%d/%m/%Y %H:%M"),
+    }
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """Dopo `failures` errori di fila il circuito si apre: le chiamate falliscono subito
+    (CircuitOpen) invece di aspettare il timeout. Passato `cooldown` passa una sola
+    chiamata di prova: se va bene il circuito si richiude, altrimenti si riapre."""
+
+    def __init__(self, failures: int, cooldown: float):
+        self._failures = failures
+        self._cooldown = cooldown
+        self._lock = threading.Lock()
+        self._errors = 0
+        self._opened_at = None
+        self._probing = False
+
+    def before(self):
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if self._probing or time.monotonic() - self._opened_at < self._cooldown:
+                raise CircuitOpen("Upstream non disponibile, nuovo tentativo più tardi")
+            self._probing = True
+
+    def success(self):
+        with self._lock:
+            self._errors = 0
+            self._opened_at = None
+            self._probing = False
+
+    def failure(self):
+        with self._lock:
+            self._errors += 1
+            if self._probing or self._errors >= self._failures:
+                self._opened_at = time.monotonic()
+            self._probing = False
+
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            return "half-open" if self._probing else "open"
+
+
+class CouponFetcher:
+    """GET della pagina promo su una Session condivisa (connessioni riusate) con
+    richieste condizionali: su 304 si riusa il parse precedente senza riscaricare
+    né ripassare da BeautifulSoup."""
+
+    def __init__(self, url: str, breaker: CircuitBreaker):
+        self.url = url
+        self.breaker = breaker
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=COUPON_POOL, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._validators = {}   # If-None-Match / If-Modified-Since dell'ultimo 200
+        self._last = None
+        self.stats = {"fetches": 0, "not_modified": 0}
+
+    def __call__(self):
+        self.breaker.before()
+        headers = dict(self._validators) if self._last is not None else {}
+        try:
+            r = self.session.get(self.url, timeout=COUPON_TIMEOUT, headers=headers)
+            if r.status_code != 304:
+                r.raise_for_status()
+        except requests.RequestException:
+            self.breaker.failure()
+            raise
+        self.breaker.success()
+        if r.status_code == 304:
+            self.stats["not_modified"] += 1
+            self._last = dict(self._last, fetched_at=datetime.now().strftime("%d/%m/%Y %H:%M"))
+            return self._last
+        self.stats["fetches"] += 1
+        validators = {}
+        if r.headers.get("ETag"):
+            validators["If-None-Match"] = r.headers["ETag"]
+        if r.headers.get("Last-Modified"):
+            validators["If-Modified-Since"] = r.headers["Last-Modified"]
+        self._last = parse_coupon(r.text)
+        self._validators = validators
+        return self._last
+
+
+fetch_coupon = CouponFetcher(COUPON_URL, CircuitBreaker(COUPON_FAILURES, COUPON_COOLDOWN))
+
+
+def tuesdays_until(expiry_date):
+    # genera martedì fino a expiry_date (dipende da oggi: non va in cache)
     tuesdays = []
-    today = date.today()
-    d = today
+    d = date.today()
     while expiry_date and d <= expiry_date:
         if d.weekday() == 1:  # 0=lunedì, 1=martedì
             tuesdays.append(d)
         d += timedelta(days=1)
+    return tuesdays
+
+
+# ================== CACHE ==================
+class CouponBusy(Exception):
+    pass
+
+
+class _Flight:
+    """Un fetch in corso: chi arriva mentre gira aspetta questo invece di rifarlo."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SwrCache:
+    """Un solo valore con TTL e stale-while-revalidate:
+    - più giovane di `ttl`: servito così com'è;
+    - più vecchio ma entro `stale_max`: servito subito, mentre un thread lo aggiorna;
+    - assente o troppo vecchio (o `force`): si aspetta il fetch.
+    In ogni momento c'è al più un fetch in corso (single-flight): le richieste
+    concorrenti si accodano a quello. Se il fetch fallisce resta il valore vecchio.
+    Il fetch gira su `executor`; ad aspettarlo restano al più `max_waiting` richieste
+    per al più `wait` secondi, le altre escono subito con CouponBusy.
+    """
+
+    def __init__(self, fetch, ttl: float, stale_max: float, executor, max_waiting: int, wait: float):
+        self._fetch = fetch
+        self._ttl = ttl
+        self._stale_max = stale_max
+        self._executor = executor
+        self._waiting = threading.BoundedSemaphore(max_waiting)
+        self._wait = wait
+        self._lock = threading.Lock()
+        self._value = None
+        self._fetched_at = 0.0
+        self._flight = None
+        self.stats = {"hits": 0, "stale": 0, "misses": 0, "fetches": 0, "errors": 0, "busy": 0}
+
+    def get(self, force: bool = False):
+        with self._lock:
+            age = time.monotonic() - self._fetched_at
+            if self._value is not None and not force:
+                if age < self._ttl:
+                    self.stats["hits"] += 1
+                    return self._value
+                if age < self._stale_max:
+                    self.stats["stale"] += 1
+                    if self._flight is None:
+                        self._flight = _Flight()
+                        self._executor.submit(self._run, self._flight)
+                    return self._value
+            self.stats["misses"] += 1
+            flight = self._flight
+            if flight is None:
+                flight = self._flight = _Flight()
+                self._executor.submit(self._run, flight)
+        # il fetch parte comunque: chi non può aspettare troverà la cache già calda
+        if not self._waiting.acquire(blocking=False):
+            return self._busy()
+        try:
+            done = flight.done.wait(self._wait)
+        finally:
+            self._waiting.release()
+        if not done:
+            return self._busy()
+        if flight.error is not None:
+            with self._lock:
+                stale = self._value
+            if stale is not None:
+                return stale
+            raise flight.error
+        return flight.value
+
+    def _busy(self):
+        with self._lock:
+            self.stats["busy"] += 1
+            stale = self._value
+        if stale is not None:
+            return stale
+        raise CouponBusy("Aggiornamento coupon in corso, riprova tra poco")
+
+    def _run(self, flight):
+        try:
+            value = self._fetch()
+        except Exception as exc:
+            flight.error = exc
+            with self._lock:
+                self.stats["errors"] += 1
+            log.warning("Aggiornamento coupon fallito: %s", exc)
+        else:
+            flight.value = value
+            with self._lock:
+                self._value = value
+                self._fetched_at = time.monotonic()
+                self.stats["fetches"] += 1
+        finally:
+            with self._lock:
+                if self._flight is flight:
+                    self._flight = None
+            flight.done.set()
+
+    def clear(self):
+        with self._lock:
+            self._value = None
+            self._fetched_at = 0.0
 
+
+# un thread basta: col single-flight c'è al più un fetch alla volta
+coupon_io = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pm-coupon-io")
+coupon_cache = SwrCache(fetch_coupon, COUPON_TTL, COUPON_STALE_MAX, coupon_io, COUPON_WAITING, COUPON_WAIT)
+
+
+@bp_coupon.route("/coupon")
+def coupon():
+    # ?refresh=1 (pulsante "Aggiorna") forza un fetch, sempre uno solo alla volta
+    try:
+        data = coupon_cache.get(force=request.args.get("refresh") == "1")
+    except (requests.RequestException, CircuitOpen, CouponBusy):
+        # upstream giù o lento e niente in cache: pagina vuota subito invece di un 500
+        return render_template(
+            "coupon.html",
+            coupon_name=None,
+            expiry=None,
+            tuesdays=[],
+            fetched_at="dati non disponibili",
+            source_url=COUPON_URL,
+        ), 503, {"Retry-After": "5"}
     return render_template(
         "coupon.html",
-        coupon_name=coupon_name,
-        expiry=expiry,
-        tuesdays=tuesdays
+        coupon_name=data["coupon_name"],
+        expiry=data["expiry"],
+        expires_text=data["expiry"],
+        tuesdays=tuesdays_until(data["expiry_date"]),
+        fetched_at=data["fetched_at"],
+        source_url=COUPON_URL,
     )
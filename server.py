@@ -1,9 +1,13 @@
 # server.py
-from flask import Flask, request, jsonify, session, render_template
-import os, json, threading, io, zipfile, re
-from datetime import datetime, date, timedelta
+from flask import Flask, Request, request, jsonify, session, render_template, Response, stream_with_context, g
+import os, json, threading, io, zipfile, re, sqlite3, hashlib, hmac, time, queue, uuid, tempfile, zlib, fcntl, mmap, struct, bisect
+import cProfile, pstats
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, ExitStack
+from datetime import datetime, date, timedelta, timezone
 
-from routes.coupon import bp_coupon
+from routes.coupon import bp_coupon, coupon_cache
 
 # ================== CONFIG ==================
 SECRET_KEY     = "cambia-questa-chiave"   # CAMBIA in produzione
@@ -12,8 +16,63 @@ PM_DATA_DIR    = "data"
 PM_PAUSE_FILE  = "pauses.json"
 PM_WEEKS_DEF   = 39
 PM_MIN_P_DEF   = 4
+PM_DAY_CACHE_SIZE = 128                   # giorni tenuti in memoria (LRU)
+PM_STORAGE     = os.environ.get("PM_STORAGE", "json")   # "json" | "sqlite"
+# più processi worker sugli stessi dati (gunicorn.conf.py lo imposta): lock su file
+# (fcntl) oltre a quelli in memoria; il change log di JsonStorage è letto da tutti i worker
+PM_MULTIPROCESS = os.environ.get("PM_MULTIPROCESS") == "1"
+PM_SQLITE_FILE = "presenze.sqlite3"
+PM_CHANGE_LOG_FILE   = "_changes.log"      # change log append-only (storage json)
+PM_LOG_COMPACT_EVERY = 30                  # secondi tra una compattazione e l'altra
+PM_LOG_COMPACT_MAX   = 500                 # oltre questi record compatta subito
+PM_LOCK_DIR          = ".locks"            # sotto PM_DATA_DIR, file per i lock fcntl
+PM_LOCK_STRIPES      = 64                  # lock per data (striping)
+PM_SHARED_FILE       = "version"           # sotto PM_LOCK_DIR, versione dati condivisa tra i worker
+PM_SHARED_RING       = 256                 # ultimi giorni scritti che gli altri worker rileggono uno a uno
+PM_SHARED_EVENTS     = 256                 # ultimi eventi SSE inoltrati ai client degli altri worker
+PM_SHARED_EVENT_SIZE = 512                 # byte per evento (JSON); uno più grande diventa un reload
+PM_SHARED_POLL       = 1                   # secondi tra due controlli della versione (solo per /events)
+PM_NAME_INDEX_FILE   = "_names_index.json"
+PM_SSE_PING          = 15                  # secondi tra i keepalive di /events
+PM_SSE_HISTORY       = 256                 # eventi tenuti per la ripresa (Last-Event-ID)
+# stream /events aperti insieme in un processo: ognuno tiene un thread, oltre -> 503 e il
+# client ripiega sul polling. Non impostato = nessun limite (gunicorn.conf.py lo imposta)
+PM_SSE_MAX           = int(os.environ["PM_SSE_MAX"]) if os.environ.get("PM_SSE_MAX") else None
+PM_SSE_RETRY         = 60                  # secondi suggeriti (Retry-After) quando /events è pieno
+PM_PAUSE_RECHECK     = 2                   # secondi tra due stat di pauses.json
+PM_BATCH_MAX         = 52                  # date per /save_batch
+PM_RULES_FILE        = "rules.json"        # regole ricorrenti per persona
+PM_RULE_EVERY_MAX    = 4                   # "ogni N settimane", N massimo
+# limiti del restore (difesa da archivi enormi o zip bomb)
+PM_RESTORE_SPOOL       = 1 * 1024 * 1024   # oltre, un file caricato va su file temporaneo
+PM_RESTORE_MAX_UPLOAD  = 50 * 1024 * 1024  # byte compressi
+PM_RESTORE_MAX_MEMBERS = 5000              # file nell'archivio
+PM_RESTORE_MAX_MEMBER  = 2 * 1024 * 1024   # byte decompressi per file
+PM_RESTORE_MAX_TOTAL   = 200 * 1024 * 1024 # byte decompressi in tutto (su tutta la catena)
+PM_RESTORE_MAX_CHAIN   = 60                # archivi in una catena full + incrementali
+# corpo della richiesta di restore (tutti gli archivi + campi del form): oltre, 413
+# prima che Werkzeug scriva l'upload su disco. Uno zip compresso non supera il suo
+# contenuto decompresso se non per le intestazioni (~1 MB per archivio con
+# PM_RESTORE_MAX_MEMBERS file): più di così la catena sforerebbe comunque PM_RESTORE_MAX_TOTAL
+PM_RESTORE_MAX_REQUEST = PM_RESTORE_MAX_TOTAL + PM_RESTORE_MAX_CHAIN * 1024 * 1024
+PM_MAX_REQUEST         = 1 * 1024 * 1024   # corpo massimo per tutte le altre richieste
+PM_JOB_WORKERS       = 2                   # operazioni admin in background in parallelo
+PM_JOB_MAX_ACTIVE    = 8                   # job in coda o in corso, oltre -> 429
+PM_JOB_HISTORY       = 50                  # job conclusi consultabili da /admin/jobs
+PM_JOBS_DIR          = "jobs"              # sotto PM_LOCK_DIR, stato e file dei job (solo con PM_MULTIPROCESS)
+PM_JOB_SYNC          = 0.5                 # secondi minimi tra due salvataggi dell'avanzamento su file
+PM_METRICS_TOKEN     = os.environ.get("PM_METRICS_TOKEN")  # /metrics: admin loggato, o "Bearer <token>" se impostato
+PM_METRICS_DIR       = "metrics"           # sotto PM_LOCK_DIR, uno snapshot per worker
+PM_METRICS_FLUSH     = 5                   # secondi tra due snapshot (solo con PM_MULTIPROCESS)
+# limiti superiori dei bucket degli istogrammi, in secondi
+PM_METRICS_BUCKETS   = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+PM_PROFILE_DIR       = "_profiles"         # sotto PM_DATA_DIR, profili cProfile richiesti dall'admin
+PM_PROFILE_KEEP      = 20                  # profili tenuti, i più vecchi vengono cancellati
+PM_PROFILE_TOP       = 60                  # righe nel riepilogo testuale
 
 VALID_STATUSES = {"presence", "online"}
+# stati accettati da /save: "absent" serve solo a scavalcare una regola ricorrente
+ENTRY_STATUSES = VALID_STATUSES | {"absent"}
 
 # --- ADMIN ---
 ADMIN_PASSCODE = "abcCBA123$miosolomio"  # CAMBIA in produzione
@@ -23,14 +82,511 @@ def require_admin():
         return jsonify({"success": False, "error": "Non autorizzato"}), 401
 
 
+class _Request(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        # i file caricati restano in RAM solo fino a PM_RESTORE_SPOOL; spool_upload
+        # poi si tiene questo stesso file, senza copiarlo
+        return tempfile.SpooledTemporaryFile(max_size=PM_RESTORE_SPOOL, mode="rb+")
+
+
 app = Flask(__name__)
+app.request_class = _Request
 app.secret_key = SECRET_KEY
+app.config["MAX_CONTENT_LENGTH"] = PM_MAX_REQUEST
+
+@app.errorhandler(413)
+def _too_large(_e):
+    return jsonify({"success": False, "error": "Richiesta troppo grande"}), 413
 os.makedirs(PM_DATA_DIR, exist_ok=True)
 app.register_blueprint(bp_coupon)
 
-# lock per scritture concorrenti sui file JSON
+if PM_MULTIPROCESS:
+    os.makedirs(os.path.join(PM_DATA_DIR, PM_LOCK_DIR), exist_ok=True)
+
+@contextmanager
+def file_lock(name: str, shared: bool = False):
+    """flock su data/.locks/<name>.lock (esclusivo, o condiviso per chi legge soltanto),
+    solo con PM_MULTIPROCESS. Il file si apre a ogni uso: un fd ereditato dal fork
+    condividerebbe il lock con gli altri worker invece di escluderli."""
+    if not PM_MULTIPROCESS:
+        yield
+        return
+    fd = os.open(os.path.join(PM_DATA_DIR, PM_LOCK_DIR, f"{name}.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)  # rilascia anche il flock
+
+# ================== METRICHE ==================
+class Metrics:
+    """Contatori e istogrammi esposti da /metrics nel formato testo di Prometheus.
+    Un aggiornamento è un lock e un paio di operazioni su dict: qualche microsecondo.
+    Con più worker ognuno salva periodicamente uno snapshot in data/.locks/metrics e
+    /metrics li somma (i contatori di un worker terminato restano nel suo file)."""
+
+    def __init__(self, buckets):
+        self._buckets = buckets
+        self._lock = threading.Lock()
+        self._counters = {}   # (nome, etichette) -> valore
+        self._hists = {}      # (nome, etichette) -> [conteggi per bucket (+Inf in fondo), somma]
+        self._meta = {}       # nome -> (tipo, descrizione)
+        self._collectors = []
+
+    def describe(self, name: str, kind: str, text: str):
+        self._meta[name] = (kind, text)
+
+    def collector(self, fn):
+        """fn() -> [(nome, {etichette}, valore)]: contatori tenuti altrove, letti allo snapshot."""
+        self._collectors.append(fn)
+        return fn
+
+    def inc(self, name: str, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        i = bisect.bisect_left(self._buckets, seconds)
+        with self._lock:
+            h = self._hists.get(key)
+            if h is None:
+                h = self._hists[key] = [[0] * (len(self._buckets) + 1), 0.0]
+            h[0][i] += 1
+            h[1] += seconds
+
+    def snapshot(self):
+        with self._lock:
+            counters = [[n, list(ls), v] for (n, ls), v in self._counters.items()]
+            hists = [[n, list(ls), list(h[0]), h[1]] for (n, ls), h in self._hists.items()]
+        for fn in self._collectors:
+            counters.extend([n, sorted(ls.items()), v] for n, ls, v in fn())
+        return {"counters": counters, "hists": hists}
+
+    def render(self, snapshots) -> str:
+        counters, hists = {}, {}
+        for snap in snapshots:
+            for n, ls, v in snap["counters"]:
+                key = (n, tuple(map(tuple, ls)))
+                counters[key] = counters.get(key, 0) + v
+            for n, ls, counts, total in snap["hists"]:
+                key = (n, tuple(map(tuple, ls)))
+                h = hists.setdefault(key, [[0] * len(counts), 0.0])
+                h[0] = [a + b for a, b in zip(h[0], counts)]
+                h[1] += total
+        out, described = [], set()
+
+        def header(name, kind):
+            if name not in described:
+                described.add(name)
+                out.append(f"# HELP {name} {self._meta.get(name, (kind, name))[1]}")
+                out.append(f"# TYPE {name} {kind}")
+
+        for (n, ls), v in sorted(counters.items()):
+            header(n, "counter")
+            out.append(f"{n}{_prom_labels(ls)} {v}")
+        bounds = [*(repr(float(b)) for b in self._buckets), "+Inf"]
+        for (n, ls), (counts, total) in sorted(hists.items()):
+            header(n, "histogram")
+            acc = 0
+            for le, c in zip(bounds, counts):
+                acc += c
+                out.append(f"{n}_bucket{_prom_labels(ls + (('le', le),))} {acc}")
+            out.append(f"{n}_sum{_prom_labels(ls)} {total}")
+            out.append(f"{n}_count{_prom_labels(ls)} {acc}")
+        return "\n".join(out) + "\n"
+
+def _prom_escape(v) -> str:
+    return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _prom_labels(labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_prom_escape(v)}"' for k, v in labels) + "}"
+
+metrics = Metrics(PM_METRICS_BUCKETS)
+metrics.describe("pm_http_requests_total", "counter", "Richieste HTTP per endpoint, metodo e codice")
+metrics.describe("pm_http_request_duration_seconds", "histogram", "Durata delle richieste per endpoint (fino alla risposta, non allo streaming del corpo)")
+metrics.describe("pm_day_reads_total", "counter", "Giorni letti dallo storage (file json o righe sqlite), cache esclusa")
+metrics.describe("pm_day_writes_total", "counter", "Giorni scritti nello storage")
+metrics.describe("pm_day_bytes_written_total", "counter", "Byte scritti nei file giorno json")
+metrics.describe("pm_change_log_records_total", "counter", "Record aggiunti al change log (storage json)")
+metrics.describe("pm_change_log_bytes_total", "counter", "Byte aggiunti al change log (storage json)")
+metrics.describe("pm_day_parse_seconds", "histogram", "Tempo di parse JSON di un giorno (file o summary sqlite)")
+metrics.describe("pm_write_lock_wait_seconds", "histogram", "Attesa per prendere write_guard")
+metrics.describe("pm_write_lock_hold_seconds", "histogram", "Tempo passato dentro write_guard")
+metrics.describe("pm_day_cache_total", "counter", "Eventi della cache LRU dei giorni")
+metrics.describe("pm_coupon_cache_total", "counter", "Eventi della cache del coupon (hit, stale, miss, fetch, errori, busy)")
+
+@metrics.collector
+def _coupon_metrics():
+    return [("pm_coupon_cache_total", {"event": k}, v) for k, v in coupon_cache.stats.items()]
+
+def metrics_dir() -> str:
+    return os.path.join(PM_DATA_DIR, PM_LOCK_DIR, PM_METRICS_DIR)
+
+if PM_MULTIPROCESS:
+    # con preload_app è il master: gli snapshot di un avvio precedente non valgono più
+    os.makedirs(metrics_dir(), exist_ok=True)
+    for _fn in os.listdir(metrics_dir()):
+        os.remove(os.path.join(metrics_dir(), _fn))
+
+_metrics_flusher_pid = None
+
+def _metrics_flusher():
+    path = os.path.join(metrics_dir(), f"{os.getpid()}.json")
+    while True:
+        time.sleep(PM_METRICS_FLUSH)
+        try:
+            atomic_write_json(path, metrics.snapshot())
+        except Exception:
+            app.logger.exception("Snapshot metriche fallito")
+
+@app.before_request
+def _metrics_start():
+    global _metrics_flusher_pid
+    g.pm_started = time.perf_counter()
+    if PM_MULTIPROCESS and _metrics_flusher_pid != os.getpid():
+        # un thread per worker, avviato dopo il fork
+        _metrics_flusher_pid = os.getpid()
+        threading.Thread(target=_metrics_flusher, name="pm-metrics", daemon=True).start()
+
+@app.after_request
+def _metrics_finish(resp):
+    started = g.get("pm_started")
+    if started is not None:
+        endpoint = request.endpoint or "none"
+        metrics.observe("pm_http_request_duration_seconds", time.perf_counter() - started, endpoint=endpoint)
+        metrics.inc("pm_http_requests_total", endpoint=endpoint, method=request.method, code=resp.status_code)
+    return resp
+
+@app.get("/metrics")
+def api_metrics():
+    # chiuso di default: il token (per lo scraper) vale solo se configurato
+    token_ok = bool(PM_METRICS_TOKEN) and hmac.compare_digest(
+        request.headers.get("Authorization", "").encode("utf-8"), f"Bearer {PM_METRICS_TOKEN}".encode("utf-8"))
+    if not token_ok and not session.get("is_admin"):
+        return jsonify({"success": False, "error": "Non autorizzato"}), 401
+    snapshots = [metrics.snapshot()]
+    if PM_MULTIPROCESS:
+        own = f"{os.getpid()}.json"
+        for fn in os.listdir(metrics_dir()):
+            if fn == own or not fn.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(metrics_dir(), fn), "r", encoding="utf-8") as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+    return Response(metrics.render(snapshots), mimetype="text/plain; version=0.0.4")
+
+# ================== PROFILING ==================
+# Un admin aggiunge ?_profile=1 (o l'header X-PM-Profile: 1) a una richiesta: l'handler
+# gira sotto cProfile e il risultato finisce in data/_profiles, da dove il pannello lo
+# scarica. Senza flag il costo è una lettura di header e query string.
+PROFILE_ID_RE = re.compile(r"^[0-9a-f]{12}$")
+_profile_lock = threading.Lock()   # un profilo alla volta per processo
+_profile_files_lock = threading.Lock()
+
+def profile_dir() -> str:
+    return os.path.join(PM_DATA_DIR, PM_PROFILE_DIR)
+
+def _profile_requested() -> bool:
+    return request.headers.get("X-PM-Profile") == "1" or request.args.get("_profile") == "1"
+
+def save_profile(prof, label: str, started_at: str, seconds: float, **extra) -> str:
+    """Scrive <id>.prof (formato pstats, apribile con snakeviz o pstats) e <id>.json
+    con i metadati; oltre PM_PROFILE_KEEP profili cancella i più vecchi."""
+    stats = pstats.Stats(prof)
+    pid = uuid.uuid4().hex[:12]
+    os.makedirs(profile_dir(), exist_ok=True)
+    path = os.path.join(profile_dir(), f"{pid}.prof")
+    tmp = f"{path}.{os.getpid()}.tmp"
+    stats.dump_stats(tmp)
+    os.replace(tmp, path)
+    atomic_write_json(os.path.join(profile_dir(), f"{pid}.json"), {
+        "id": pid,
+        "label": label,
+        "created_at": started_at,
+        "duration_ms": round(seconds * 1000, 1),
+        "calls": stats.total_calls,
+        "pid": os.getpid(),
+        **extra,
+    })
+    with _profile_files_lock, file_lock("profiles"):
+        for meta in list_profiles()[PM_PROFILE_KEEP:]:
+            for ext in ("json", "prof"):
+                _remove_quietly(os.path.join(profile_dir(), f"{meta['id']}.{ext}"))
+    return pid
+
+def list_profiles():
+    """Metadati dei profili salvati, dal più recente."""
+    out = []
+    try:
+        names = os.listdir(profile_dir())
+    except FileNotFoundError:
+        return out
+    for fn in names:
+        if fn.endswith(".json"):
+            try:
+                with open(os.path.join(profile_dir(), fn), "r", encoding="utf-8") as f:
+                    out.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+    out.sort(key=lambda m: m.get("created_at") or "", reverse=True)
+    return out
+
+def profile_text(pid: str) -> str:
+    buf = io.StringIO()
+    stats = pstats.Stats(os.path.join(profile_dir(), f"{pid}.prof"), stream=buf)
+    stats.sort_stats("cumulative").print_stats(PM_PROFILE_TOP)
+    return buf.getvalue()
+
+@app.before_request
+def _profile_start():
+    if not _profile_requested() or not session.get("is_admin"):
+        return
+    if not _profile_lock.acquire(blocking=False):
+        g.pm_profile_busy = True
+        return
+    prof = cProfile.Profile()
+    g.pm_profile = {"prof": prof, "started": time.perf_counter(), "at": datetime.utcnow().isoformat(), "status": None}
+    prof.enable()
+
+@app.after_request
+def _profile_status(resp):
+    if g.get("pm_profile") is not None:
+        g.pm_profile["status"] = resp.status_code
+    elif g.get("pm_profile_busy"):
+        resp.headers["X-PM-Profile"] = "busy"
+    return resp
+
+@app.teardown_request
+def _profile_stop(exc):
+    run = g.pop("pm_profile", None)
+    if run is None:
+        return
+    try:
+        run["prof"].disable()
+        label = f"{request.method} {request.path}"
+        save_profile(run["prof"], label, run["at"], time.perf_counter() - run["started"],
+                     endpoint=request.endpoint, status=run["status"] or 500)
+    except Exception:
+        app.logger.exception("Salvataggio profilo fallito")
+    finally:
+        _profile_lock.release()
+
+def profiled_job(kind: str, fn):
+    """fn di un job avviato da una richiesta profilata: il lavoro vero gira nel pool,
+    quindi si profila anche lì (dopo aver aspettato che finisca il profilo della richiesta)."""
+    def run(job, *args):
+        if not _profile_lock.acquire(timeout=30):
+            return fn(job, *args)
+        prof, started, at = cProfile.Profile(), time.perf_counter(), datetime.utcnow().isoformat()
+        try:
+            prof.enable()
+            try:
+                return fn(job, *args)
+            finally:
+                prof.disable()
+                try:
+                    save_profile(prof, f"job {kind}", at, time.perf_counter() - started, job_id=job.id)
+                except Exception:
+                    app.logger.exception("Salvataggio profilo fallito")
+        finally:
+            _profile_lock.release()
+    return run
+
+# lock globale per pause, regole e operazioni admin sull'intero archivio
 write_lock = threading.Lock()
 
+@contextmanager
+def write_guard():
+    """write_lock più, tra processi, il suo lock su file. Ordine: write_guard -> date_lock."""
+    t0 = time.perf_counter()
+    with write_lock, file_lock("write"):
+        t1 = time.perf_counter()
+        metrics.observe("pm_write_lock_wait_seconds", t1 - t0)
+        try:
+            yield
+        finally:
+            metrics.observe("pm_write_lock_hold_seconds", time.perf_counter() - t1)
+
+# lock per data (striping): martedì diversi si scrivono in parallelo, lo stesso
+# martedì fa read-modify-write sotto un solo lock. crc32 e non hash(): la stripe
+# deve essere la stessa in tutti i processi
+_date_locks = [threading.Lock() for _ in range(PM_LOCK_STRIPES)]
+
+def _stripe(dstr: str) -> int:
+    return zlib.crc32(dstr.encode("utf-8")) % PM_LOCK_STRIPES
+
+def date_lock(dstr: str):
+    return date_locks([dstr])
+
+@contextmanager
+def date_locks(dates):
+    """Più date_lock insieme, sempre in ordine di stripe (niente deadlock)."""
+    with ExitStack() as stack:
+        for i in sorted({_stripe(d) for d in dates}):
+            stack.enter_context(_date_locks[i])
+            stack.enter_context(file_lock(f"day-{i}"))
+        yield
+
+# versione globale dei dati: cresce a ogni modifica e genera gli ETag delle letture.
+# È un istante in ns (mai meno dell'orologio), quindi resta monotona tra un riavvio e
+# l'altro e fa anche da riferimento "modificato dopo" per i backup incrementali
+_data_version = time.time_ns()
+_data_modified_at = datetime.utcnow()
+_data_version_lock = threading.Lock()
+
+def bump_data_version(days=(), pauses: bool = False, rules: bool = False, reset: bool = False):
+    """Da chiamare dopo ogni modifica, dicendo cosa è cambiato: con più worker gli altri
+    processi riallineano solo quello (giorni in `days`, pause, regole; `reset` = tutto)."""
+    global _data_version, _data_modified_at
+    with _data_version_lock:
+        _data_version = max(_data_version + 1, time.time_ns())
+        _data_modified_at = datetime.utcnow()
+        version = _data_version
+    if shared_state is not None:
+        version = _adopt_version(shared_state.publish(version, days, pauses, rules, reset))
+    return version
+
+def _adopt_version(version: int) -> int:
+    global _data_version, _data_modified_at
+    with _data_version_lock:
+        if version > _data_version:
+            _data_version = version
+            _data_modified_at = datetime.utcnow()
+        return _data_version
+
+def data_version() -> int:
+    return _data_version
+
+class SharedState:
+    """Versione dei dati condivisa tra i worker (PM_MULTIPROCESS): un file in data/.locks
+    mappato in memoria con versione, epoca (purge e restore grandi), contatori di pause
+    e regole, un anello con gli ultimi giorni scritti e uno con gli ultimi eventi SSE (che
+    gli altri worker ripubblicano ai loro client). Chi scrive lo aggiorna sotto flock;
+    a ogni richiesta si confrontano versione ed eventi (16 byte) con gli ultimi visti e
+    solo se sono cambiati si legge il resto, per riallineare ciò che è cambiato davvero."""
+
+    HEADER = struct.Struct("<6Q")    # versione, epoca, pause, regole, seq ultimo giorno, seq ultimo evento
+    SLOT = struct.Struct("<QI4x")    # seq, data come AAAAMMGG
+    EVENT = struct.Struct("<QIH2x")  # seq, pid di chi l'ha pubblicato, lunghezza del JSON che segue
+
+    def __init__(self, path: str, ring: int, events: int, event_size: int):
+        self._ring = ring
+        self._events = events
+        self._event_size = event_size
+        self._events_at = self.HEADER.size + ring * self.SLOT.size
+        size = self._events_at + events * event_size
+        with file_lock(PM_SHARED_FILE):
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                if os.fstat(fd).st_size < size:
+                    os.ftruncate(fd, size)
+                self._mm = mmap.mmap(fd, size)
+            finally:
+                os.close(fd)
+        self._lock = threading.Lock()
+        self._seen = self.HEADER.unpack_from(self._mm, 0)
+
+    def _slot_offset(self, seq: int) -> int:
+        return self.HEADER.size + (seq % self._ring) * self.SLOT.size
+
+    def _event_offset(self, seq: int) -> int:
+        return self._events_at + (seq % self._events) * self._event_size
+
+    def publish_event(self, event: dict):
+        """Mette un evento SSE di questo processo nell'anello per gli altri worker."""
+        raw = json.dumps(event, ensure_ascii=False).encode("utf-8")
+        if len(raw) > self._event_size - self.EVENT.size:
+            raw = EventBroker.RELOAD.encode("utf-8")
+        with self._lock, file_lock(PM_SHARED_FILE):
+            head = self.HEADER.unpack_from(self._mm, 0)
+            evseq = head[5] + 1
+            at = self._event_offset(evseq)
+            self.EVENT.pack_into(self._mm, at, evseq, os.getpid(), len(raw))
+            self._mm[at + self.EVENT.size:at + self.EVENT.size + len(raw)] = raw
+            new = head[:5] + (evseq,)
+            self.HEADER.pack_into(self._mm, 0, *new)
+            if head == self._seen:
+                self._seen = new
+
+    def publish(self, version: int, days, pauses: bool, rules: bool, reset: bool) -> int:
+        """Registra una modifica fatta da questo processo; ritorna la versione condivisa."""
+        days = sorted(set(days))
+        with self._lock, file_lock(PM_SHARED_FILE):
+            head = self.HEADER.unpack_from(self._mm, 0)
+            shared, epoch, n_pauses, n_rules, seq, evseq = head
+            version = max(version, shared + 1)
+            if reset or len(days) > self._ring:
+                epoch += 1
+            else:
+                for d in days:
+                    seq += 1
+                    self.SLOT.pack_into(self._mm, self._slot_offset(seq), seq, int(d.replace("-", "")))
+            new = (version, epoch, n_pauses + pauses, n_rules + rules, seq, evseq)
+            self.HEADER.pack_into(self._mm, 0, *new)
+            # se nel frattempo ha scritto un altro worker, le sue modifiche le
+            # raccoglie la prossima sync (che rilegge anche le nostre: è idempotente)
+            if head == self._seen:
+                self._seen = new
+        return version
+
+    def sync(self, apply):
+        """Se la versione condivisa o gli eventi sono cambiati chiama
+        apply(version, days, pauses, rules, events), con days=None se va ricaricato tutto
+        ed events=None se l'anello degli eventi ha perso qualcosa. Un solo thread per volta."""
+        if struct.unpack_from("<Q", self._mm, 0)[0] == self._seen[0] \
+                and struct.unpack_from("<Q", self._mm, 40)[0] == self._seen[5]:
+            return False
+        with self._lock:
+            seen = self._seen
+            with file_lock(PM_SHARED_FILE, shared=True):
+                head = self.HEADER.unpack_from(self._mm, 0)
+                if head == seen:
+                    return False
+                days = set()
+                if head[1] != seen[1] or head[4] - seen[4] > self._ring:
+                    days = None
+                else:
+                    for q in range(seen[4] + 1, head[4] + 1):
+                        slot_seq, ymd = self.SLOT.unpack_from(self._mm, self._slot_offset(q))
+                        if slot_seq != q:
+                            days = None
+                            break
+                        days.add(f"{ymd // 10000:04d}-{ymd // 100 % 100:02d}-{ymd % 100:02d}")
+                events = self._read_events(seen[5], head[5])
+            apply(head[0], days, head[2] != seen[2], head[3] != seen[3], events)
+            self._seen = head
+        return True
+
+    def _read_events(self, seen: int, last: int):
+        # sotto flock: gli eventi degli altri processi tra seen (escluso) e last
+        if last - seen > self._events:
+            return None
+        out = []
+        pid = os.getpid()
+        for q in range(seen + 1, last + 1):
+            at = self._event_offset(q)
+            ev_seq, ev_pid, size = self.EVENT.unpack_from(self._mm, at)
+            if ev_seq != q:
+                return None
+            if ev_pid == pid:
+                continue
+            try:
+                out.append(json.loads(bytes(self._mm[at + self.EVENT.size:at + self.EVENT.size + size])))
+            except ValueError:
+                return None
+        return out
+
+shared_state = None
+if PM_MULTIPROCESS:
+    shared_state = SharedState(os.path.join(PM_DATA_DIR, PM_LOCK_DIR, PM_SHARED_FILE), PM_SHARED_RING,
+                               PM_SHARED_EVENTS, PM_SHARED_EVENT_SIZE)
+
 # ================== UTIL ==================
 def is_tuesday(dstr: str) -> bool:
     try:
@@ -45,58 +601,122 @@ def next_tuesdays(weeks: int):
     first = today + timedelta(days=offset)
     return [(first + timedelta(days=i*7)).strftime("%Y-%m-%d") for i in range(weeks)]
 
+DAY_JSON_RE = re.compile(r"^\d{4}-\d{2}-\d{2}\.json$")
+
 def day_path(dstr: str) -> str:
     return os.path.join(PM_DATA_DIR, f"{dstr}.json")
 
-def read_day(dstr: str):
-    """Struttura base:
-    {
-      "date": "YYYY-MM-DD",
-      "entries": [{"name": "...", "status": "presence|online"}],
-      "updated_at": "iso"
-    }
-    """
-    p = day_path(dstr)
-    if not os.path.exists(p):
-        return {"date": dstr, "entries": [], "updated_at": None}
+def list_day_json_files():
+    files = []
+    for fn in os.listdir(PM_DATA_DIR):
+        if DAY_JSON_RE.match(fn):
+            files.append(fn)
+    return sorted(files)
+
+# cache LRU dei giorni letti: dstr -> ((mtime_ns, size, ino), data)
+_day_cache = OrderedDict()
+_day_cache_lock = threading.Lock()
+day_cache_stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+@metrics.collector
+def _day_cache_metrics():
+    return [("pm_day_cache_total", {"event": k}, v) for k, v in day_cache_stats.items()]
+
+def _empty_day(dstr: str):
+    return with_aggregates({"date": dstr, "entries": [], "updated_at": None})
+
+def with_aggregates(data: dict):
+    """Materializza su `data` ciò che /list e /summary calcolavano a ogni richiesta:
+    liste ordinate per stato, conteggi e lower(nome) -> stato (per find_status).
+    Va chiamata quando il giorno cambia, non in lettura."""
+    lists = {"presence": [], "online": []}
+    by_name = {}
+    for e in data["entries"]:
+        raw = e.get("name") or ""
+        st = (e.get("status") or "").strip().lower()
+        n = sanitize_name(raw)
+        if st in lists and n:
+            lists[st].append(n)
+        by_name.setdefault(raw.lower(), e.get("status"))
+    for k in lists:
+        lists[k] = sorted(lists[k], key=str.lower)
+    data["lists"] = lists
+    data["counts"] = {k: len(v) for k, v in lists.items()}
+    data["status_by_name"] = by_name
+    return data
+
+def day_record(data: dict):
+    """Solo i campi persistiti nel file giorno (senza gli aggregati)."""
+    return {"date": data.get("date"), "entries": data.get("entries", []), "updated_at": data.get("updated_at")}
+
+def _file_stamp(p: str):
+    try:
+        st = os.stat(p)
+    except OSError:
+        return None
+    # l'inode cambia a ogni os.replace: copre due scritture nello stesso tick di mtime
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+def _copy_day(data: dict):
+    # copia superficiale: i chiamanti possono rimpiazzare "entries" senza sporcare la cache
+    out = dict(data)
+    out["entries"] = list(data["entries"])
+    return out
+
+def _load_day_file(dstr: str, p: str):
+    metrics.inc("pm_day_reads_total")
     try:
         with open(p, "r", encoding="utf-8") as f:
+            t0 = time.perf_counter()
             data = json.load(f)
+            metrics.observe("pm_day_parse_seconds", time.perf_counter() - t0)
             if not isinstance(data, dict):
-                return {"date": dstr, "entries": [], "updated_at": None}
+                return _empty_day(dstr)
             if "entries" not in data or not isinstance(data["entries"], list):
                 data["entries"] = []
-            return data
+            return with_aggregates(data)
     except Exception:
-        return {"date": dstr, "entries": [], "updated_at": None}
-
-def write_day(dstr: str, entry: dict):
-    data = read_day(dstr)
-    name = (entry.get("name") or "").strip()
-    status = (entry.get("status") or "").strip()
-    # rimpiazza o aggiunge l'entry per lo stesso nome
-    new_entries, replaced = [], False
-    for e in data["entries"]:
-        if (e.get("name") or "").lower() == name.lower():
-            new_entries.append({"name": name, "status": status})
-            replaced = True
-        else:
-            new_entries.append(e)
-    if not replaced:
-        new_entries.append({"name": name, "status": status})
-    data["entries"] = new_entries
-    data["updated_at"] = datetime.utcnow().isoformat()
-
-    with write_lock:
-        with open(day_path(dstr), "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-    return data
+        return _empty_day(dstr)
 
-def find_status(entries, name: str):
-    for e in entries:
-        if (e.get("name") or "").lower() == (name or "").lower():
-            return e.get("status")
-    return None
+def atomic_write_json(path: str, payload) -> int:
+    """File temporaneo + fsync + os.replace: chi legge vede il file vecchio o quello
+    nuovo, mai un JSON a metà (che read_day trasformerebbe in un giorno vuoto).
+    Ritorna i byte scritti."""
+    tmp = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(payload, f, ensure_ascii=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+            size = f.tell()
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+    return size
+
+def _cache_day(dstr: str, stamp, data: dict):
+    with _day_cache_lock:
+        _day_cache[dstr] = (stamp, data)
+        _day_cache.move_to_end(dstr)
+        while len(_day_cache) > PM_DAY_CACHE_SIZE:
+            _day_cache.popitem(last=False)
+            day_cache_stats["evictions"] += 1
+
+def invalidate_day_cache(dstr: str = None):
+    """Scarta un giorno (o tutta la cache se dstr è None)."""
+    with _day_cache_lock:
+        if dstr is None:
+            day_cache_stats["invalidations"] += len(_day_cache)
+            _day_cache.clear()
+        elif _day_cache.pop(dstr, None) is not None:
+            day_cache_stats["invalidations"] += 1
+
+def find_status(day: dict, name: str):
+    return day["status_by_name"].get((name or "").lower())
 
 def sanitize_name(raw: str) -> str:
     raw = (raw or "").strip()
@@ -106,7 +726,12 @@ def sanitize_name(raw: str) -> str:
 def pause_path() -> str:
     return os.path.join(PM_DATA_DIR, PM_PAUSE_FILE)
 
-def read_pauses():
+# calendario pause in memoria: (stamp file, ultimo controllo, payload, frozenset date).
+# write_pauses e il restore lo aggiornano direttamente; lo stat del file (al massimo
+# ogni PM_PAUSE_RECHECK secondi) copre le modifiche fatte da fuori.
+_pause_state = None
+
+def _load_pauses_file():
     p = pause_path()
     if not os.path.exists(p):
         return {"paused_dates": [], "updated_at": None}
@@ -127,12 +752,49 @@ def read_pauses():
     out.sort()
     return {"paused_dates": out, "updated_at": data.get("updated_at") if isinstance(data, dict) else None}
 
-def write_pauses(paused_dates):
-    valid = normalize_paused_dates(paused_dates)
-    payload = {"paused_dates": valid, "updated_at": datetime.utcnow().isoformat()}
-    with write_lock:
-        with open(pause_path(), "w", encoding="utf-8") as f:
-            json.dump(payload, f, ensure_ascii=False, indent=2)
+def _set_pause_state(stamp, payload):
+    global _pause_state
+    _pause_state = (stamp, time.monotonic(), payload, frozenset(payload["paused_dates"]))
+    return _pause_state
+
+def _current_pauses():
+    state = _pause_state
+    if state is not None and time.monotonic() - state[1] < PM_PAUSE_RECHECK:
+        return state
+    stamp = _file_stamp(pause_path())
+    if state is not None and state[0] == stamp:
+        return _set_pause_state(stamp, state[2])
+    return _set_pause_state(stamp, _load_pauses_file())
+
+def refresh_pauses(payload=None):
+    """Da chiamare dopo aver scritto pauses.json (payload=None: rileggi alla prossima richiesta)."""
+    global _pause_state
+    if payload is None:
+        _pause_state = None
+    else:
+        _set_pause_state(_file_stamp(pause_path()), payload)
+
+def read_pauses():
+    payload = _current_pauses()[2]
+    return {"paused_dates": list(payload["paused_dates"]), "updated_at": payload["updated_at"]}
+
+def paused_set() -> frozenset:
+    """Martedì in pausa, per i controlli di appartenenza nei percorsi caldi."""
+    return _current_pauses()[3]
+
+def set_pause(dstr: str, paused: bool):
+    """Mette o toglie una pausa. Il calendario si rilegge dal file sotto write_guard:
+    la copia in memoria può non avere ancora le modifiche di un altro worker."""
+    with write_guard():
+        current = set(_load_pauses_file()["paused_dates"])
+        if paused:
+            current.add(dstr)
+        else:
+            current.discard(dstr)
+        payload = {"paused_dates": normalize_paused_dates(sorted(current)), "updated_at": datetime.utcnow().isoformat()}
+        atomic_write_json(pause_path(), payload)
+        refresh_pauses(payload)
+    bump_data_version(pauses=True)
     return payload
 
 def normalize_paused_dates(paused_dates):
@@ -146,6 +808,1377 @@ def normalize_paused_dates(paused_dates):
     valid.sort()
     return valid
 
+# ================== REGOLE RICORRENTI ==================
+# Una regola per persona ("sempre in presenza", "online una settimana sì e una no"),
+# salvata una volta in rules.json e applicata in lettura: le entry esplicite di /save
+# (compreso "absent") vincono sulla regola di quel giorno.
+_rules_state = None  # (stamp file, ultimo controllo, payload, regole compilate)
+
+def rules_path() -> str:
+    return os.path.join(PM_DATA_DIR, PM_RULES_FILE)
+
+def normalize_rule(name: str, raw: dict):
+    """Valida una regola; ValueError con messaggio per l'utente se non va."""
+    name = sanitize_name(name)
+    status = (raw.get("status") or "").strip().lower()
+    if not name:
+        raise ValueError("Nome mancante")
+    if status not in VALID_STATUSES:
+        raise ValueError("Stato non valido")
+    try:
+        every = int(raw.get("every") or 1)
+    except (TypeError, ValueError):
+        raise ValueError("Frequenza non valida")
+    if not 1 <= every <= PM_RULE_EVERY_MAX:
+        raise ValueError(f"Frequenza non valida (1-{PM_RULE_EVERY_MAX} settimane)")
+    anchor = (raw.get("anchor") or "").strip() or next_tuesdays(1)[0]
+    if not is_tuesday(anchor):
+        raise ValueError("Data di inizio non valida (martedì, YYYY-MM-DD)")
+    until = (raw.get("until") or "").strip() or None
+    if until is not None and not is_tuesday(until):
+        raise ValueError("Data di fine non valida (martedì, YYYY-MM-DD)")
+    return {"name": name, "status": status, "every": every, "anchor": anchor, "until": until}
+
+def _load_rules_file():
+    try:
+        with open(rules_path(), "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except Exception:
+        return {"rules": {}, "updated_at": None}
+    raw = data.get("rules", {}) if isinstance(data, dict) else {}
+    rules = {}
+    for r in raw.values() if isinstance(raw, dict) else []:
+        try:
+            rule = normalize_rule(r.get("name"), r)
+        except (ValueError, AttributeError):
+            continue
+        rules[rule["name"].lower()] = rule
+    return {"rules": rules, "updated_at": data.get("updated_at") if isinstance(data, dict) else None}
+
+def _compile_rules(payload):
+    return [
+        {
+            "key": k,
+            "name": r["name"],
+            "status": r["status"],
+            "every": r["every"],
+            "anchor": date.fromisoformat(r["anchor"]),
+            "until": date.fromisoformat(r["until"]) if r["until"] else None,
+        }
+        for k, r in payload["rules"].items()
+    ]
+
+def _set_rules_state(stamp, payload):
+    global _rules_state
+    _rules_state = (stamp, time.monotonic(), payload, _compile_rules(payload))
+    return _rules_state
+
+def _current_rules():
+    state = _rules_state
+    if state is not None and time.monotonic() - state[1] < PM_PAUSE_RECHECK:
+        return state
+    stamp = _file_stamp(rules_path())
+    if state is not None and state[0] == stamp:
+        return _set_rules_state(stamp, state[2])
+    return _set_rules_state(stamp, _load_rules_file())
+
+def read_rules():
+    payload = _current_rules()[2]
+    return {"rules": dict(payload["rules"]), "updated_at": payload["updated_at"]}
+
+def update_rules(change):
+    """Read-modify-write delle regole: `change(rules)` modifica il dict riletto dal file
+    sotto write_guard (mai dalla copia in memoria, che può essere indietro)."""
+    with write_guard():
+        rules = _load_rules_file()["rules"]
+        change(rules)
+        payload = {"rules": rules, "updated_at": datetime.utcnow().isoformat()}
+        atomic_write_json(rules_path(), payload)
+        _set_rules_state(_file_stamp(rules_path()), payload)
+    bump_data_version(rules=True)
+    return payload
+
+def refresh_rules():
+    global _rules_state
+    _rules_state = None
+
+def apply_rules(data: dict, paused=frozenset()):
+    """Giorno con gli aggregati + i nomi la cui regola cade in quella data e che non
+    hanno un'entry esplicita. Non tocca `data` (può essere condiviso con la cache)."""
+    rules = _current_rules()[3]
+    dstr = data["date"]
+    if not rules or dstr in paused:
+        return data
+    day = date.fromisoformat(dstr)
+    by_name = data["status_by_name"]
+    extra = [
+        r for r in rules
+        if r["key"] not in by_name
+        and day >= r["anchor"]
+        and (r["until"] is None or day <= r["until"])
+        and ((day - r["anchor"]).days // 7) % r["every"] == 0
+    ]
+    if not extra:
+        return data
+    lists = {k: list(v) for k, v in data["lists"].items()}
+    by_name = dict(by_name)
+    for r in extra:
+        lists[r["status"]].append(r["name"])
+        by_name[r["key"]] = r["status"]
+    for k in lists:
+        lists[k].sort(key=str.lower)
+    out = dict(data)
+    out.update(lists=lists, counts={k: len(v) for k, v in lists.items()}, status_by_name=by_name)
+    return out
+
+def read_day_views(dates):
+    """Come storage.read_days, con le regole ricorrenti già applicate."""
+    paused = paused_set()
+    return {d: apply_rules(data, paused) for d, data in storage.read_days(dates).items()}
+
+# ================== INDICE NOMI ==================
+class NameIndex:
+    """Nomi noti, aggiornati da chi scrive: /names risponde dalla memoria senza
+    rileggere lo storico. lower(nome) -> nome visualizzato + martedì in cui compare.
+    Con lo storage json è salvato in data/_names_index.json insieme a un'impronta
+    dei file giorno; all'avvio, se l'impronta non torna, viene ricostruito.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._names = {}    # key -> nome visualizzato
+        self._dates = {}    # key -> set(dstr)
+        self._days = {}     # dstr -> set(key)
+        self._sorted = None
+        self.dirty = False
+
+    # ---- sotto _lock ----
+    def _add(self, dstr: str, name: str):
+        n = sanitize_name(name)
+        if not n:
+            return
+        k = n.lower()
+        self._names[k] = n
+        self._dates.setdefault(k, set()).add(dstr)
+        self._days.setdefault(dstr, set()).add(k)
+
+    def _remove_day(self, dstr: str):
+        for k in self._days.pop(dstr, ()):
+            ds = self._dates.get(k)
+            if ds is not None:
+                ds.discard(dstr)
+                if not ds:
+                    del self._dates[k]
+                    self._names.pop(k, None)
+
+    def _changed(self):
+        self._sorted = None
+        self.dirty = True
+
+    # ---- aggiornamenti ----
+    def add(self, dstr: str, name: str):
+        with self._lock:
+            self._add(dstr, name)
+            self._changed()
+
+    def set_day(self, dstr: str, entries):
+        """Rimpiazza i nomi di un giorno (put_day, delete_day, restore)."""
+        with self._lock:
+            self._remove_day(dstr)
+            for e in entries:
+                self._add(dstr, e.get("name") or "")
+            self._changed()
+
+    def drop_names(self, keys):
+        with self._lock:
+            for k in keys:
+                for d in self._dates.pop(k, ()):
+                    self._days.get(d, set()).discard(k)
+                self._names.pop(k, None)
+            self._changed()
+
+    def clear(self):
+        with self._lock:
+            self._names.clear()
+            self._dates.clear()
+            self._days.clear()
+            self._changed()
+
+    # ---- letture ----
+    def names(self):
+        with self._lock:
+            if self._sorted is None:
+                self._sorted = sorted(self._names.values(), key=str.lower)
+            return self._sorted
+
+    def dates_for(self, keys):
+        """Martedì in cui compare almeno uno dei nomi (chiavi lower, spazi normalizzati
+        come in sanitize_name): chi cancella o cerca per nome visita solo questi giorni."""
+        with self._lock:
+            out = set()
+            for k in keys:
+                out.update(self._dates.get(sanitize_name(k).lower(), ()))
+            return sorted(out)
+
+    def info(self):
+        with self._lock:
+            return {
+                self._names[k]: {"first_seen": min(ds), "last_seen": max(ds), "count": len(ds)}
+                for k, ds in self._dates.items()
+            }
+
+    # ---- persistenza ----
+    def rebuild(self, source):
+        with self._lock:
+            self._names.clear()
+            self._dates.clear()
+            self._days.clear()
+            for dstr, name in source.iter_day_names():
+                self._add(dstr, name)
+            self._changed()
+
+    def save(self, fingerprint):
+        # l'impronta va presa prima della copia: un file cambiato dopo fa solo ricostruire
+        with self._lock:
+            payload = {
+                "fingerprint": fingerprint,
+                "names": dict(self._names),
+                "days": {d: sorted(ks) for d, ks in self._days.items()},
+            }
+            self.dirty = False
+        atomic_write_json(name_index_path(), payload)
+
+    def load(self, fingerprint) -> bool:
+        try:
+            with open(name_index_path(), "r", encoding="utf-8") as f:
+                payload = json.load(f)
+            if payload.get("fingerprint") != fingerprint:
+                return False
+            names, days = payload["names"], payload["days"]
+        except Exception:
+            return False
+        with self._lock:
+            self._names = dict(names)
+            self._days = {d: set(ks) for d, ks in days.items()}
+            self._dates = {}
+            for d, ks in self._days.items():
+                for k in ks:
+                    self._dates.setdefault(k, set()).add(d)
+            self._sorted = None
+        return True
+
+    def load_or_rebuild(self, source):
+        fp = source.fingerprint()
+        if fp is not None and self.load(fp):
+            # le modifiche ancora nel change log non sono nell'impronta
+            for d in source.pending_dates():
+                self.set_day(d, source.read_day(d)["entries"])
+        else:
+            self.rebuild(source)
+
+name_index = NameIndex()
+
+
+# ================== STORAGE ==================
+# Tutte le letture/scritture dei giorni passano da `storage`; read_day/write_day
+# restano l'interfaccia usata dalle route.
+
+class JsonStorage:
+    """Un file data/YYYY-MM-DD.json per martedì (formato storico), più un change log
+    append-only: ogni /save aggiunge una riga a _changes.log (fsync) invece di
+    riscrivere il giorno. Lo stato è snapshot + modifiche pendenti del log; il thread
+    di compattazione le riporta periodicamente negli snapshot e svuota il log.
+
+    Record del log: {"d", "n", "s", "t"} imposta lo stato di un nome; {"d", "r": 1, "t"}
+    (scritto da put_day/delete_day) scarta le modifiche precedenti di quel giorno,
+    così un replay non resuscita prenotazioni sovrascritte da restore o cancellazioni.
+    Ordine dei lock: date_lock -> _log_lock -> _tail_lock.
+
+    Con più processi il log è condiviso: si appende sotto il lock su file "log" e prima
+    di ogni lettura si applicano le righe aggiunte dagli altri, ripartendo dall'offset
+    già letto (uno stat se non è cambiato nulla). Se il file è stato sostituito (una
+    compattazione o un purge altrove) si scartano i pendenti e si rilegge segmento
+    sigillato + log: rieseguire record già negli snapshot è idempotente.
+    """
+    name = "json"
+
+    def __init__(self):
+        # dstr -> {"entries": {lower(name): entry}, "updated_at": iso,
+        #          "v": versione, "view": (stamp snapshot, giorno unito con aggregati)}
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._log_lock = threading.Lock()
+        self._tail_lock = threading.Lock()
+        self._compact_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._log_records = 0
+        self._log_pos = None      # (inode, byte già applicati) del log, None se non c'è
+        self._wake = threading.Event()
+        self._compactor_pid = None
+        with self._tail_lock:
+            self._reload_log()
+        if PM_MULTIPROCESS:
+            # nel master, prima del fork: il thread si avvia in ogni worker alla prima scrittura
+            self.compact()
+        else:
+            self._start_compactor()
+
+    # ---- change log ----
+    def _apply_record(self, rec):
+        with self._pending_lock:
+            if rec.get("r"):
+                self._pending.pop(rec["d"], None)
+                return
+            name = rec["n"]
+            pend = self._pending.setdefault(rec["d"], {"entries": {}, "updated_at": None, "v": 0, "view": None})
+            pend["entries"][name.lower()] = {"name": name, "status": rec["s"]}
+            pend["updated_at"] = rec["t"]
+            pend["v"] += 1
+            pend["view"] = None
+        name_index.add(rec["d"], name)
+
+    def _append_log(self, *recs):
+        # più record = una sola write e un solo fsync
+        data = "".join(json.dumps(r, ensure_ascii=False, separators=(",", ":")) + "\n" for r in recs).encode("utf-8")
+        metrics.inc("pm_change_log_records_total", len(recs))
+        metrics.inc("pm_change_log_bytes_total", len(data))
+        self._start_compactor()
+        with self._log_lock, file_lock("log"):
+            with open(change_log_path(), "a+b") as f:
+                self._trim_torn_tail(f)
+                before = os.fstat(f.fileno())
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            with self._tail_lock:
+                # nessun altro ha scritto dall'ultima lettura: le nostre righe non vanno rilette
+                if self._log_pos == (before.st_ino, before.st_size):
+                    self._log_pos = (before.st_ino, before.st_size + len(data))
+                    self._log_records += len(recs)
+            if self._log_records >= PM_LOG_COMPACT_MAX:
+                self._wake.set()
+
+    @staticmethod
+    def _trim_torn_tail(f):
+        """Se il file non finisce con \n (append interrotto da un crash) lo tronca all'ultima
+        riga completa: la prossima riga scritta finirebbe attaccata a quella a metà e il
+        replay le scarterebbe entrambe. Sotto il lock del log; chi legge non supera mai
+        l'ultimo \n, quindi gli offset già letti restano validi."""
+        end = f.seek(0, os.SEEK_END)
+        if not end:
+            return
+        f.seek(end - 1)
+        if f.read(1) == b"\n":
+            return
+        pos = end
+        while pos > 0:
+            step = min(pos, 64 * 1024)
+            f.seek(pos - step)
+            i = f.read(step).rfind(b"\n")
+            if i >= 0:
+                pos = pos - step + i + 1
+                break
+            pos -= step
+        app.logger.warning("Change log %s: scartati %d byte di una riga troncata", f.name, end - pos)
+        f.truncate(pos)
+        f.flush()
+        os.fsync(f.fileno())
+
+    def _read_records(self, f, offset: int) -> int:
+        """Applica le righe complete da `offset` in poi; ritorna il nuovo offset.
+        Una riga senza \\n è un append ancora in corso (o troncato da un crash)."""
+        f.seek(offset)
+        data = f.read()
+        cut = data.rfind(b"\n") + 1
+        for line in data[:cut].splitlines():
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                continue  # riga troncata da un crash a metà append
+            self._apply_record(rec)
+            self._log_records += 1
+        return offset + cut
+
+    def _reload_log(self):
+        """Pendenti da zero: segmento sigillato (se una compattazione è in corso o è stata
+        interrotta) e poi log attivo. Sotto _tail_lock."""
+        with self._pending_lock:
+            self._pending.clear()
+        self._log_records = 0
+        self._log_pos = None
+        with ExitStack() as stack:
+            files = {}
+            # prima il log: se intanto viene sigillato lo leggiamo due volte, mai zero
+            for key, p in (("log", change_log_path()), ("sealed", sealed_log_path())):
+                try:
+                    files[key] = stack.enter_context(open(p, "rb"))
+                except FileNotFoundError:
+                    pass
+            if "sealed" in files:
+                self._read_records(files["sealed"], 0)
+            if "log" in files:
+                self._log_pos = (os.fstat(files["log"].fileno()).st_ino, self._read_records(files["log"], 0))
+
+    def _catch_up(self):
+        """Righe aggiunte al log dagli altri processi dall'ultima volta."""
+        with self._tail_lock:
+            try:
+                st = os.stat(change_log_path())
+            except FileNotFoundError:
+                st = None
+            pos = self._log_pos
+            if st is None and pos is None:
+                return
+            if st is not None and pos is not None and pos[0] == st.st_ino:
+                if st.st_size > pos[1]:
+                    try:
+                        with open(change_log_path(), "rb") as f:
+                            if os.fstat(f.fileno()).st_ino == pos[0]:
+                                self._log_pos = (pos[0], self._read_records(f, pos[1]))
+                                return
+                    except FileNotFoundError:
+                        pass
+                else:
+                    return
+            self._reload_log()
+
+    @staticmethod
+    def _merge(data, pend):
+        changes = dict(pend["entries"])
+        merged = []
+        for e in data["entries"]:
+            merged.append(changes.pop((e.get("name") or "").lower(), e))
+        merged.extend(changes.values())
+        return with_aggregates({"date": data["date"], "entries": merged, "updated_at": pend["updated_at"]})
+
+    def _drop_pending(self, dstr: str):
+        # chiamare sotto date_lock(dstr)
+        with self._pending_lock:
+            self._pending.pop(dstr, None)
+        self._append_log({"d": dstr, "r": 1, "t": datetime.utcnow().isoformat()})
+
+    def _start_compactor(self):
+        # un thread per processo: quello del master non sopravvive al fork
+        if self._compactor_pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._compactor_pid == os.getpid():
+                return
+            self._compactor_pid = os.getpid()
+            threading.Thread(target=self._compactor, name="pm-compactor", daemon=True).start()
+
+    def _compactor(self):
+        while True:
+            self._wake.wait(PM_LOG_COMPACT_EVERY)
+            self._wake.clear()
+            try:
+                self.compact()
+                if name_index.dirty:
+                    name_index.save(self.fingerprint())
+            except Exception:
+                app.logger.exception("Compattazione change log fallita")
+
+    def compact(self):
+        """Riporta le modifiche del log negli snapshot e tronca il log.
+        Il log attivo viene sigillato (rename) e i /save ripartono subito su un log
+        nuovo; poi ogni giorno pendente viene riscritto sotto il proprio date_lock.
+        Rieseguire il log su uno snapshot già aggiornato è idempotente, quindi un
+        crash a metà non perde né duplica nulla. Con più processi compatta uno alla
+        volta (lock su file "compact"), con le righe di tutti."""
+        with self._compact_lock, file_lock("compact"):
+            log, sealed = change_log_path(), sealed_log_path()
+            with self._log_lock, file_lock("log"):
+                self._catch_up()
+                if not self._log_records and not os.path.exists(sealed):
+                    return 0
+                if os.path.exists(log):
+                    if os.path.exists(sealed):
+                        with open(log, "rb") as src, open(sealed, "a+b") as dst:
+                            self._trim_torn_tail(dst)
+                            dst.write(src.read())
+                            dst.flush()
+                            os.fsync(dst.fileno())
+                        os.remove(log)
+                    else:
+                        os.replace(log, sealed)
+                with self._tail_lock:
+                    self._log_pos = None
+                    self._log_records = 0
+            with self._pending_lock:
+                dates = list(self._pending)
+            for d in dates:
+                with date_lock(d):
+                    # righe di d arrivate dal log nuovo prima che prendessimo il lock
+                    self._catch_up()
+                    with self._pending_lock:
+                        pend = self._pending.get(d)
+                    if not pend:
+                        continue
+                    self._write_snapshot(d, self._merge(self._snapshot(d)[1], pend))
+                    # sotto date_lock nessun /save può aver toccato d nel frattempo
+                    with self._pending_lock:
+                        self._pending.pop(d, None)
+            try:
+                os.remove(sealed)
+            except FileNotFoundError:
+                pass
+        return len(dates)
+
+    def pending_dates(self):
+        self._catch_up()
+        with self._pending_lock:
+            return list(self._pending)
+
+    def fingerprint(self):
+        """Numero, mtime massimo e dimensione totale dei file giorno (solo stat)."""
+        count, newest, total = 0, 0, 0
+        with os.scandir(PM_DATA_DIR) as it:
+            for de in it:
+                if DAY_JSON_RE.match(de.name):
+                    st = de.stat()
+                    count += 1
+                    newest = max(newest, st.st_mtime_ns)
+                    total += st.st_size
+        return [count, newest, total]
+
+    def log_stats(self):
+        self._catch_up()
+        with self._pending_lock:
+            pending_days = len(self._pending)
+        return {"records": self._log_records, "pending_days": pending_days}
+
+    # ---- snapshot ----
+    def _snapshot(self, dstr: str):
+        """(stamp, giorno) dalla cache; il giorno è condiviso e va trattato in sola lettura."""
+        p = day_path(dstr)
+        stamp = _file_stamp(p)
+        if stamp is None:
+            invalidate_day_cache(dstr)
+            return None, _empty_day(dstr)
+        with _day_cache_lock:
+            hit = _day_cache.get(dstr)
+            if hit is not None and hit[0] == stamp:
+                _day_cache.move_to_end(dstr)
+                day_cache_stats["hits"] += 1
+                return stamp, hit[1]
+            day_cache_stats["misses"] += 1
+        data = _load_day_file(dstr, p)
+        _cache_day(dstr, stamp, data)
+        return stamp, data
+
+    def _write_snapshot(self, dstr: str, payload: dict):
+        p = day_path(dstr)
+        record = day_record(payload)
+        metrics.inc("pm_day_bytes_written_total", atomic_write_json(p, record))
+        metrics.inc("pm_day_writes_total")
+        _cache_day(dstr, _file_stamp(p), with_aggregates(record))
+
+    def _put_locked(self, dstr: str, payload: dict):
+        # prima il record di reset nel log, poi lo snapshot: con un crash in mezzo il
+        # replay non rimette sul giorno nuovo le entry che ha sostituito o tolto
+        self._drop_pending(dstr)
+        self._write_snapshot(dstr, payload)
+        name_index.set_day(dstr, payload.get("entries", []))
+
+    # ---- interfaccia storage ----
+    def read_day(self, dstr: str):
+        """Struttura base:
+        {
+          "date": "YYYY-MM-DD",
+          "entries": [{"name": "...", "status": "presence|online"}],
+          "updated_at": "iso"
+        }
+        più gli aggregati di with_aggregates. Lo snapshot è servito dalla cache finché
+        il file non cambia; il giorno unito alle modifiche pendenti è calcolato una volta
+        per versione (di solito dalla stessa write_day) e poi riusato.
+        """
+        self._catch_up()
+        stamp, snap = self._snapshot(dstr)
+        with self._pending_lock:
+            pend = self._pending.get(dstr)
+            if pend is None:
+                return _copy_day(snap)
+            if pend["view"] is not None and pend["view"][0] == stamp:
+                return _copy_day(pend["view"][1])
+            version = pend["v"]
+            changes = {"entries": dict(pend["entries"]), "updated_at": pend["updated_at"]}
+        view = self._merge(snap, changes)
+        with self._pending_lock:
+            if self._pending.get(dstr) is pend and pend["v"] == version:
+                pend["view"] = (stamp, view)
+        return _copy_day(view)
+
+    def read_days(self, dates):
+        return {d: self.read_day(d) for d in dates}
+
+    def write_day(self, dstr: str, entry: dict):
+        rec = {
+            "d": dstr,
+            "n": (entry.get("name") or "").strip(),
+            "s": (entry.get("status") or "").strip(),
+            "t": datetime.utcnow().isoformat(),
+        }
+        with date_lock(dstr):
+            self._append_log(rec)
+            self._apply_record(rec)
+            return self.read_day(dstr)
+
+    def write_days(self, name: str, items):
+        """Stesso nome su più martedì: un'acquisizione dei lock e un solo fsync."""
+        name = (name or "").strip()
+        now = datetime.utcnow().isoformat()
+        recs = [{"d": d, "n": name, "s": (st or "").strip(), "t": now} for d, st in items]
+        with date_locks([r["d"] for r in recs]):
+            self._append_log(*recs)
+            for rec in recs:
+                self._apply_record(rec)
+            return {r["d"]: self.read_day(r["d"]) for r in recs}
+
+    def put_day(self, dstr: str, payload: dict):
+        with date_lock(dstr):
+            self._put_locked(dstr, payload)
+            return self.read_day(dstr)
+
+    def delete_day(self, dstr: str):
+        with date_lock(dstr):
+            self._drop_pending(dstr)  # come in _put_locked: il reset prima del file
+            try:
+                os.remove(day_path(dstr))
+            except OSError:
+                pass
+            invalidate_day_cache(dstr)
+            name_index.set_day(dstr, [])
+
+    def changed_since(self, since: datetime):
+        """Date con file modificato dopo `since` (mtime, solo stat) o con modifiche pendenti
+        più recenti. Una compattazione riscrive i file: al più include giorni in più."""
+        cutoff_ns = int(since.replace(tzinfo=timezone.utc).timestamp() * 1e9)
+        iso = since.isoformat()
+        dates = set()
+        self._catch_up()
+        with os.scandir(PM_DATA_DIR) as it:
+            for de in it:
+                if DAY_JSON_RE.match(de.name) and de.stat().st_mtime_ns > cutoff_ns:
+                    dates.add(de.name[:-5])
+        with self._pending_lock:
+            dates.update(d for d, p in self._pending.items() if (p["updated_at"] or "") > iso)
+        return sorted(dates)
+
+    def day_dates(self):
+        self._catch_up()
+        dates = {fn[:-5] for fn in list_day_json_files()}
+        with self._pending_lock:
+            dates.update(self._pending)
+        return sorted(dates)
+
+    def iter_day_names(self):
+        for d in self.day_dates():
+            for e in self.read_day(d)["entries"]:
+                yield d, e.get("name") or ""
+
+    def delete_names(self, targets_lower, progress=None):
+        removed_total, days_touched = 0, 0
+        # l'indice nomi dice quali giorni aprire; gli altri non vengono nemmeno letti
+        dates = name_index.dates_for(targets_lower)
+        for i, d in enumerate(dates, 1):
+            if progress:
+                progress(i - 1, len(dates))
+            with date_lock(d):
+                data = self.read_day(d)
+                kept = [e for e in data["entries"] if (e.get("name") or "").strip().lower() not in targets_lower]
+                removed_here = len(data["entries"]) - len(kept)
+                if removed_here > 0:
+                    data["entries"] = kept
+                    data["updated_at"] = datetime.utcnow().isoformat()
+                    self._put_locked(d, data)
+                    removed_total += removed_here
+                    days_touched += 1
+        return removed_total, days_touched
+
+    def purge(self, progress=None):
+        with self._compact_lock, file_lock("compact"), self._log_lock, file_lock("log"), self._tail_lock:
+            with self._pending_lock:
+                self._pending.clear()
+            self._log_records = 0
+            self._log_pos = None
+            for p in (change_log_path(), sealed_log_path()):
+                try:
+                    os.remove(p)
+                except OSError:
+                    pass
+            name_index.clear()
+            return remove_json_files(progress)
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS days (
+    date       TEXT PRIMARY KEY,
+    updated_at TEXT,
+    summary    TEXT                 -- JSON: lists, counts, status_by_name
+);
+CREATE TABLE IF NOT EXISTS entries (
+    date     TEXT NOT NULL,
+    name_key TEXT NOT NULL,          -- lower(name)
+    name     TEXT NOT NULL,
+    status   TEXT NOT NULL,
+    PRIMARY KEY (date, name_key)
+);
+CREATE INDEX IF NOT EXISTS entries_by_name ON entries(name_key);
+"""
+
+class SqliteStorage:
+    """Unico file SQLite in WAL: una riga per (martedì, nome).
+    L'ordine di inserimento delle entry è preservato dal rowid (l'upsert non lo cambia).
+    """
+    name = "sqlite"
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        # senza preload ogni worker arriva qui insieme agli altri: il passaggio a WAL e lo
+        # schema su un file nuovo possono dare "database is locked" anche con il timeout
+        with file_lock("sqlite"):
+            db = self._conn()
+            db.executescript(SQLITE_SCHEMA)
+            if "summary" not in {r[1] for r in db.execute("PRAGMA table_info(days)")}:
+                db.execute("ALTER TABLE days ADD COLUMN summary TEXT")
+
+    def _conn(self):
+        # una connessione per thread e per processo: dopo il fork non si riusa quella del master
+        db = getattr(self._local, "db", None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    @contextmanager
+    def _tx(self):
+        db = self._conn()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def read_days(self, dates):
+        dates = list(dates)
+        out = {d: _empty_day(d) for d in dates}
+        if not dates:
+            return out
+        db = self._conn()
+        marks = ",".join("?" * len(dates))
+        summaries = {}
+        for d, upd, summary in db.execute(
+            f"SELECT date, updated_at, summary FROM days WHERE date IN ({marks})", dates
+        ):
+            out[d]["updated_at"] = upd
+            summaries[d] = summary
+        rows = db.execute(
+            f"SELECT date, name, status FROM entries WHERE date IN ({marks}) ORDER BY date, rowid", dates
+        )
+        for d, name, status in rows:
+            out[d]["entries"].append({"name": name, "status": status})
+        metrics.inc("pm_day_reads_total", len(summaries))
+        for d, summary in summaries.items():
+            if summary:
+                t0 = time.perf_counter()
+                out[d].update(json.loads(summary))
+                metrics.observe("pm_day_parse_seconds", time.perf_counter() - t0)
+            else:
+                with_aggregates(out[d])  # riga importata prima della colonna summary
+        return out
+
+    def read_day(self, dstr: str):
+        return self.read_days([dstr])[dstr]
+
+    def write_day(self, dstr: str, entry: dict):
+        name = (entry.get("name") or "").strip()
+        status = (entry.get("status") or "").strip()
+        with self._tx() as db:
+            self._upsert_entry(db, dstr, name, status)
+            data = self._touch(db, dstr, datetime.utcnow().isoformat())
+        name_index.add(dstr, name)
+        return data
+
+    def write_days(self, name: str, items):
+        name = (name or "").strip()
+        now = datetime.utcnow().isoformat()
+        out = {}
+        with self._tx() as db:
+            for dstr, status in items:
+                self._upsert_entry(db, dstr, name, (status or "").strip())
+                out[dstr] = self._touch(db, dstr, now)
+        for dstr in out:
+            name_index.add(dstr, name)
+        return out
+
+    def put_day(self, dstr: str, payload: dict):
+        with self._tx() as db:
+            db.execute("DELETE FROM entries WHERE date = ?", (dstr,))
+            for e in payload.get("entries", []):
+                name = (e.get("name") or "").strip()
+                if name:
+                    self._upsert_entry(db, dstr, name, (e.get("status") or "").strip())
+            data = self._touch(db, dstr, payload.get("updated_at") or datetime.utcnow().isoformat())
+        name_index.set_day(dstr, data["entries"])
+        return data
+
+    def delete_day(self, dstr: str):
+        with self._tx() as db:
+            db.execute("DELETE FROM entries WHERE date = ?", (dstr,))
+            db.execute("DELETE FROM days WHERE date = ?", (dstr,))
+        name_index.set_day(dstr, [])
+
+    def day_dates(self):
+        return [r[0] for r in self._conn().execute("SELECT date FROM days ORDER BY date")]
+
+    def changed_since(self, since: datetime):
+        rows = self._conn().execute("SELECT date FROM days WHERE updated_at > ? ORDER BY date", (since.isoformat(),))
+        return [r[0] for r in rows]
+
+    def iter_day_names(self):
+        return self._conn().execute("SELECT date, name FROM entries ORDER BY date, rowid").fetchall()
+
+    def pending_dates(self):
+        return []
+
+    def fingerprint(self):
+        # il database è già persistente: l'indice si ricostruisce con una query
+        return None
+
+    def delete_names(self, targets_lower, progress=None):
+        # una sola transazione: niente avanzamento intermedio da riportare
+        keys = sorted(targets_lower)
+        if not keys:
+            return 0, 0
+        marks = ",".join("?" * len(keys))
+        now = datetime.utcnow().isoformat()
+        with self._tx() as db:
+            hits = db.execute(
+                f"SELECT date, COUNT(*) FROM entries WHERE name_key IN ({marks}) GROUP BY date", keys
+            ).fetchall()
+            db.execute(f"DELETE FROM entries WHERE name_key IN ({marks})", keys)
+            for d, _ in hits:
+                self._touch(db, d, now)
+        name_index.drop_names(keys)
+        return sum(n for _, n in hits), len(hits)
+
+    def purge(self, progress=None):
+        with self._tx() as db:
+            deleted = db.execute("SELECT COUNT(*) FROM days").fetchone()[0]
+            db.execute("DELETE FROM entries")
+            db.execute("DELETE FROM days")
+        name_index.clear()
+        # i JSON (pause e vecchi giorni) restano file: "Cancella tutto" li rimuove comunque
+        return deleted + remove_json_files(progress)
+
+    @staticmethod
+    def _upsert_entry(db, dstr, name, status):
+        db.execute(
+            "INSERT INTO entries (date, name_key, name, status) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(date, name_key) DO UPDATE SET name = excluded.name, status = excluded.status",
+            (dstr, name.lower(), name, status),
+        )
+
+    @staticmethod
+    def _touch(db, dstr, updated_at):
+        """Aggiorna updated_at e rimaterializza gli aggregati del giorno (dentro la transazione)."""
+        entries = [
+            {"name": n, "status": st}
+            for n, st in db.execute("SELECT name, status FROM entries WHERE date = ? ORDER BY rowid", (dstr,))
+        ]
+        data = with_aggregates({"date": dstr, "entries": entries, "updated_at": updated_at})
+        summary = json.dumps(
+            {k: data[k] for k in ("lists", "counts", "status_by_name")}, ensure_ascii=False, separators=(",", ":")
+        )
+        db.execute(
+            "INSERT INTO days (date, updated_at, summary) VALUES (?, ?, ?) "
+            "ON CONFLICT(date) DO UPDATE SET updated_at = excluded.updated_at, summary = excluded.summary",
+            (dstr, updated_at, summary),
+        )
+        metrics.inc("pm_day_writes_total")
+        return data
+
+
+def remove_json_files(progress=None) -> int:
+    deleted = 0
+    files = [fn for fn in os.listdir(PM_DATA_DIR) if fn.endswith(".json")]
+    for i, fn in enumerate(files, 1):
+        try:
+            os.remove(os.path.join(PM_DATA_DIR, fn))
+            deleted += 1
+        except Exception:
+            pass
+        if progress:
+            progress(i, len(files))
+    invalidate_day_cache()
+    return deleted
+
+def change_log_path() -> str:
+    return os.path.join(PM_DATA_DIR, PM_CHANGE_LOG_FILE)
+
+def sealed_log_path() -> str:
+    return change_log_path() + ".old"
+
+def name_index_path() -> str:
+    return os.path.join(PM_DATA_DIR, PM_NAME_INDEX_FILE)
+
+def sqlite_path() -> str:
+    return os.path.join(PM_DATA_DIR, PM_SQLITE_FILE)
+
+def make_storage(kind: str):
+    if kind == "sqlite":
+        return SqliteStorage(sqlite_path())
+    if kind == "json":
+        return JsonStorage()
+    raise ValueError(f"PM_STORAGE non valido: {kind!r} (usa 'json' o 'sqlite')")
+
+def migrate_json_to_sqlite(target: SqliteStorage) -> int:
+    """Importa una tantum i data/YYYY-MM-DD.json nel database (idempotente: rieseguirla
+    riscrive gli stessi giorni). I file JSON restano su disco."""
+    migrated = 0
+    for fn in list_day_json_files():
+        dstr = fn[:-5]
+        target.put_day(dstr, _load_day_file(dstr, day_path(dstr)))
+        migrated += 1
+    return migrated
+
+storage = make_storage(PM_STORAGE)
+name_index.load_or_rebuild(storage)
+
+def read_day(dstr: str):
+    return storage.read_day(dstr)
+
+def write_day(dstr: str, entry: dict):
+    data = storage.write_day(dstr, entry)
+    bump_data_version(days=[dstr])
+    return data
+
+def write_days(name: str, items):
+    """[(dstr, status), ...] per lo stesso nome -> {dstr: giorno aggiornato}."""
+    out = storage.write_days(name, items)
+    bump_data_version(days=out)
+    return out
+
+# ================== EVENTI (SSE) ==================
+class EventBrokerFull(Exception):
+    pass
+
+class EventBroker:
+    """Fan-out in-process degli eventi per /events. Gli ultimi PM_SSE_HISTORY eventi
+    restano in memoria per chi si riconnette con Last-Event-ID; se il buco è più
+    lungo (o il processo è ripartito) il client riceve {"type": "reload"}."""
+
+    RELOAD = json.dumps({"type": "reload"})
+
+    def __init__(self, history: int, queue_size: int = 100, max_subs: int = None):
+        self._lock = threading.Lock()
+        self._subs = set()
+        self._max_subs = max_subs
+        self._history = deque(maxlen=history)
+        self._queue_size = queue_size
+        self._boot = uuid.uuid4().hex[:8]
+        self._seq = 0
+
+    def publish(self, event: dict):
+        with self._lock:
+            self._seq += 1
+            msg = (f"{self._boot}-{self._seq}", json.dumps(event, ensure_ascii=False))
+            self._history.append((self._seq, msg))
+            for q in self._subs:
+                try:
+                    q.put_nowait(msg)
+                except queue.Full:
+                    # client troppo lento: meglio un reload che una coda infinita
+                    while not q.empty():
+                        q.get_nowait()
+                    q.put_nowait((msg[0], self.RELOAD))
+
+    def subscribe(self, last_id: str = None):
+        """(coda, eventi persi); EventBrokerFull se ci sono già max_subs iscritti."""
+        q = queue.Queue(maxsize=self._queue_size)
+        with self._lock:
+            if self._max_subs is not None and len(self._subs) >= self._max_subs:
+                raise EventBrokerFull()
+            backlog = self._missed(last_id)
+            self._subs.add(q)
+        return q, backlog
+
+    def unsubscribe(self, q):
+        with self._lock:
+            self._subs.discard(q)
+
+    def _missed(self, last_id):
+        if not last_id:
+            return []
+        boot, _, seq = last_id.partition("-")
+        if boot != self._boot or not seq.isdigit():
+            return [(f"{self._boot}-{self._seq}", self.RELOAD)]
+        seq = int(seq)
+        if self._history and self._history[0][0] > seq + 1:
+            return [(f"{self._boot}-{self._seq}", self.RELOAD)]
+        return [msg for s, msg in self._history if s > seq]
+
+events = EventBroker(PM_SSE_HISTORY, max_subs=PM_SSE_MAX)
+
+def sse_format(msg) -> str:
+    event_id, payload = msg
+    return f"id: {event_id}\ndata: {payload}\n\n"
+
+# ================== COERENZA TRA WORKER ==================
+# Con più processi (PM_MULTIPROCESS) ognuno ha le sue copie in memoria: indice nomi,
+# pause, regole, versione degli ETag. shared_state dice cosa è cambiato altrove; i
+# file giorno non servono, la cache li riconosce già dallo stamp.
+_watcher_pid = None
+_watcher_lock = threading.Lock()
+
+def _apply_shared(version: int, days, pauses: bool, rules: bool, forwarded):
+    _adopt_version(version)
+    if pauses:
+        refresh_pauses()
+    if rules:
+        refresh_rules()
+    if days is None:
+        invalidate_day_cache()
+        name_index.rebuild(storage)
+    else:
+        for d, data in storage.read_days(sorted(days)).items():
+            name_index.set_day(d, data["entries"])
+    # i client SSE di questo worker non hanno visto gli eventi originali: si ripubblicano.
+    # Reload solo se è cambiata l'epoca (purge, restore grandi) o se se ne sono persi
+    if days is None or forwarded is None:
+        events.publish({"type": "reload"})
+    else:
+        for ev in forwarded:
+            events.publish(ev)
+
+def publish_event(event: dict):
+    """Evento SSE per i client di questo worker e, con PM_MULTIPROCESS, degli altri."""
+    events.publish(event)
+    if shared_state is not None:
+        shared_state.publish_event(event)
+
+def sync_shared_state():
+    """O(1) se nessun altro worker ha scritto dall'ultima volta."""
+    if shared_state is not None:
+        shared_state.sync(_apply_shared)
+
+@app.before_request
+def _sync_before_request():
+    sync_shared_state()
+
+def start_shared_watcher():
+    """Un worker che ha solo client /events non riceve richieste: un thread controlla
+    la versione ogni PM_SHARED_POLL secondi. Avviato al primo client, nel processo
+    worker (un thread del master non sopravvive al fork)."""
+    global _watcher_pid
+    if shared_state is None or _watcher_pid == os.getpid():
+        return
+    with _watcher_lock:
+        if _watcher_pid == os.getpid():
+            return
+        _watcher_pid = os.getpid()
+        threading.Thread(target=_watch_shared, name="pm-shared-watch", daemon=True).start()
+
+def _watch_shared():
+    while True:
+        time.sleep(PM_SHARED_POLL)
+        try:
+            sync_shared_state()
+        except Exception:
+            app.logger.exception("Sincronizzazione tra worker fallita")
+
+# ================== JOB IN BACKGROUND ==================
+# Restore, purge, delete_names e backup girano su un pool limitato invece che dentro
+# la richiesta HTTP: la route risponde subito con l'id del job e l'admin segue
+# l'avanzamento su /admin/jobs/<id>. Con PM_MULTIPROCESS lo stato, la richiesta di
+# annullamento e il file prodotto stanno in data/.locks/jobs: il polling può arrivare
+# a qualsiasi worker, il job gira solo in quello che l'ha accodato.
+JOB_ID_RE = re.compile(r"^[0-9a-f]{12}$")
+
+def jobs_dir() -> str:
+    return os.path.join(PM_DATA_DIR, PM_LOCK_DIR, PM_JOBS_DIR)
+
+def job_file(job_id: str, ext: str) -> str:
+    return os.path.join(jobs_dir(), f"{job_id}{ext}")
+
+if PM_MULTIPROCESS:
+    # come per le metriche: i job di un avvio precedente non girano più
+    os.makedirs(jobs_dir(), exist_ok=True)
+    for _fn in os.listdir(jobs_dir()):
+        os.remove(os.path.join(jobs_dir(), _fn))
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class JobCancelled(Exception):
+    pass
+
+class JobQueueFull(Exception):
+    pass
+
+class Job:
+    FINISHED = {"done", "failed", "cancelled"}
+    _SAVED = ("kind", "state", "phase", "done", "total", "result", "error", "artifact",
+              "created_at", "finished_at", "cancellable", "owner")
+
+    def __init__(self, kind: str):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.state = "queued"
+        self.phase = None
+        self.done = 0
+        self.total = None
+        self.result = None
+        self.error = None
+        self.artifact = None      # file prodotto dal job (backup), servito da /admin/jobs/<id>/download
+        self.created_at = datetime.utcnow().isoformat()
+        self.finished_at = None
+        self.cancellable = True
+        self.owner = os.getpid()  # worker che esegue il job
+        self._cancel = threading.Event()
+        self._lock = threading.Lock()
+        self._saved_at = 0.0
+
+    @classmethod
+    def load(cls, job_id: str):
+        """Job di un altro worker, letto da jobs_dir (None se non c'è)."""
+        if not PM_MULTIPROCESS or not JOB_ID_RE.match(job_id):
+            return None
+        try:
+            with open(job_file(job_id, ".json"), "r", encoding="utf-8") as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return None
+        job = cls(saved["kind"])
+        job.id = job_id
+        for k in cls._SAVED:
+            setattr(job, k, saved.get(k))
+        if job.state not in cls.FINISHED and not _pid_alive(job.owner):
+            job.state, job.error = "failed", "Worker terminato durante il job"
+        return job
+
+    def new_artifact(self, suffix: str) -> str:
+        """File vuoto per il risultato del job; con PM_MULTIPROCESS sta in jobs_dir,
+        così il download lo serve qualsiasi worker."""
+        if PM_MULTIPROCESS:
+            path = os.path.abspath(job_file(self.id, suffix))  # send_file risolve i relativi su root_path
+            open(path, "wb").close()
+        else:
+            fd, path = tempfile.mkstemp(prefix=f"pm-{self.kind}-", suffix=suffix)
+            os.close(fd)
+        self.artifact = path
+        return path
+
+    def sync(self, force: bool = False):
+        """Con PM_MULTIPROCESS salva lo stato in jobs_dir e raccoglie l'annullamento chiesto
+        da un altro worker; senza force al più ogni PM_JOB_SYNC secondi."""
+        if not PM_MULTIPROCESS or self.owner != os.getpid():
+            return
+        now = time.monotonic()
+        if not force and now - self._saved_at < PM_JOB_SYNC:
+            return
+        self._saved_at = now
+        if os.path.exists(job_file(self.id, ".cancel")):
+            self._cancel.set()
+        try:
+            atomic_write_json(job_file(self.id, ".json"), {k: getattr(self, k) for k in self._SAVED})
+        except OSError:
+            app.logger.exception("Salvataggio stato del job %s fallito", self.id)
+
+    def progress(self, done: int, total: int = None, phase: str = None):
+        """Checkpoint: aggiorna l'avanzamento e interrompe il job se è stato annullato."""
+        self.done = done
+        if total is not None:
+            self.total = total
+        if phase is not None:
+            self.phase = phase
+        self.sync()
+        if self._cancel.is_set():
+            raise JobCancelled()
+
+    def commit(self, phase: str = None):
+        """Da qui in poi il job scrive i dati e non può più essere annullato."""
+        with self._lock, file_lock("jobs"):
+            self.sync(force=True)
+            if self._cancel.is_set():
+                raise JobCancelled()
+            self.cancellable = False
+            if phase is not None:
+                self.phase, self.done, self.total = phase, 0, None
+            self.sync(force=True)
+
+    def cancel(self) -> bool:
+        with self._lock, file_lock("jobs"):
+            if self.owner != os.getpid():
+                # job di un altro worker: lo stato si rilegge sotto lock (commit lo aggiorna
+                # tenendo lo stesso lock) e l'annullamento passa da un file
+                current = Job.load(self.id)
+                if current is None or not current.cancellable or current.state in self.FINISHED:
+                    return False
+                open(job_file(self.id, ".cancel"), "w").close()
+                return True
+            if not self.cancellable or self.state in self.FINISHED:
+                return False
+            self._cancel.set()
+            return True
+
+    def as_dict(self):
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "state": self.state,
+            "phase": self.phase,
+            "done": self.done,
+            "total": self.total,
+            "cancellable": self.cancellable and self.state not in self.FINISHED,
+            "result": self.result,
+            "error": self.error,
+            "download": f"/admin/jobs/{self.id}/download" if self.artifact and self.state == "done" else None,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+        }
+
+class JobRunner:
+    def __init__(self, workers: int, max_active: int, history: int):
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="pm-job")
+        self._lock = threading.Lock()
+        self._jobs = OrderedDict()
+        self._max_active = max_active
+        self._history = history
+
+    def submit(self, kind: str, fn, *args, cleanup=None):
+        """Accoda fn(job, *args); il valore restituito diventa job.result. Un ValueError
+        chiude il job con il suo messaggio, come un 400 nelle route sincrone.
+        `cleanup` viene chiamato comunque alla fine (anche se il job non parte mai)."""
+        with self._lock:
+            active = sum(1 for j in self._jobs.values() if j.state not in Job.FINISHED)
+            if active >= self._max_active:
+                if cleanup:
+                    cleanup()
+                raise JobQueueFull()
+            job = Job(kind)
+            self._jobs[job.id] = job
+            self._trim()
+        job.sync(force=True)
+        self._pool.submit(self._run, job, fn, args, cleanup)
+        return job
+
+    def _run(self, job, fn, args, cleanup):
+        try:
+            job.sync(force=True)
+            if job._cancel.is_set():
+                raise JobCancelled()
+            job.state = "running"
+            job.sync(force=True)
+            job.result = fn(job, *args)
+            job.state = "done"
+        except JobCancelled:
+            job.state = "cancelled"
+        except ValueError as exc:
+            job.error = str(exc)
+            job.state = "failed"
+        except Exception:
+            app.logger.exception("Job %s (%s) fallito", job.id, job.kind)
+            job.error = "Errore interno"
+            job.state = "failed"
+        finally:
+            job.finished_at = datetime.utcnow().isoformat()
+            if cleanup:
+                cleanup()
+            if job.state != "done" and job.artifact:
+                _remove_quietly(job.artifact)
+                job.artifact = None
+            with file_lock("jobs"):
+                job.sync(force=True)
+            if PM_MULTIPROCESS:
+                _remove_quietly(job_file(job.id, ".cancel"))
+
+    def _trim(self):
+        # sotto _lock: si scartano i job conclusi più vecchi (e i loro file)
+        finished = [j for j in self._jobs.values() if j.state in Job.FINISHED]
+        for j in finished[:max(0, len(finished) - self._history)]:
+            del self._jobs[j.id]
+            if j.artifact:
+                _remove_quietly(j.artifact)
+        if PM_MULTIPROCESS:
+            # jobs_dir è di tutti i worker: lo stesso limite vale per l'insieme
+            with file_lock("jobs"):
+                finished = sorted((j for j in self._shared() if j.state in Job.FINISHED),
+                                  key=lambda j: j.finished_at or "")
+                for j in finished[:max(0, len(finished) - self._history)]:
+                    self._jobs.pop(j.id, None)
+                    for ext in (".json", ".cancel"):
+                        _remove_quietly(job_file(j.id, ext))
+                    if j.artifact:
+                        _remove_quietly(j.artifact)
+
+    def _shared(self):
+        return [j for j in map(Job.load, (fn[:-5] for fn in os.listdir(jobs_dir()) if fn.endswith(".json")))
+                if j is not None]
+
+    def get(self, job_id: str):
+        with self._lock:
+            job = self._jobs.get(job_id)
+        return job if job is not None else Job.load(job_id)
+
+    def recent(self):
+        with self._lock:
+            found = {j.id: j for j in self._jobs.values()}
+        if PM_MULTIPROCESS:
+            for j in self._shared():
+                found.setdefault(j.id, j)
+        return [j.as_dict() for j in sorted(found.values(), key=lambda j: j.created_at, reverse=True)]
+
+def _remove_quietly(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+jobs = JobRunner(PM_JOB_WORKERS, PM_JOB_MAX_ACTIVE, PM_JOB_HISTORY)
+
+def submit_admin_job(kind: str, fn, *args, cleanup=None):
+    """Risposta 202 con il job appena accodato (429 se il pool è già pieno)."""
+    if g.get("pm_profile") is not None:
+        fn = profiled_job(kind, fn)
+    try:
+        job = jobs.submit(kind, fn, *args, cleanup=cleanup)
+    except JobQueueFull:
+        return jsonify({"success": False, "error": "Troppe operazioni in corso, riprova più tardi"}), 429
+    return jsonify({"success": True, "job": job.as_dict()}), 202
+
+# ================== CONDITIONAL GET ==================
+def response_etag(*parts) -> str:
+    """ETag forte: cambia con i dati (data_version), con il giorno (next_tuesdays parte
+    da oggi) e con le parti che cambiano la risposta (endpoint, utente, settimane).
+    La versione va letta prima dei dati: chi scrive la incrementa dopo aver scritto."""
+    key = json.dumps([data_version(), date.today().isoformat(), *parts], ensure_ascii=False)
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:24]
+
+def tag_response(resp, etag: str):
+    resp.set_etag(etag)
+    resp.last_modified = _data_modified_at
+    resp.headers["Cache-Control"] = "private, no-cache"
+    return resp
+
+def not_modified(etag: str):
+    """304 se il client ha già questa versione (prima di toccare qualsiasi file)."""
+    if etag in request.if_none_match:
+        return tag_response(app.response_class(status=304), etag)
+    return None
+
 # ================== ROUTES: UI ==================
 @app.route("/")
 def home():
@@ -178,26 +2211,48 @@ def api_list():
     user = session.get("user")
     if not user:
         return jsonify({"success": False, "error": "Non autenticato"}), 401
-    weeks = int(request.args.get("weeks", PM_WEEKS_DEF))
-    dates = next_tuesdays(max(1, min(52, weeks)))
-    paused_dates = set(read_pauses().get("paused_dates", []))
+    weeks = max(1, min(52, int(request.args.get("weeks", PM_WEEKS_DEF))))
+    etag = response_etag("list", user, weeks)
+    cached = not_modified(etag)
+    if cached:
+        return cached
+    dates = next_tuesdays(weeks)
+    paused_dates = paused_set()
+    days = read_day_views(dates)
     rows = []
     for d in dates:
-        data = read_day(d)
-        # SOLO due stati
-        lists = {"presence": [], "online": []}
-        for e in data["entries"]:
-            st = (e.get("status") or "").strip().lower()
-            n  = sanitize_name(e.get("name") or "")
-            if st in lists and n:
-                lists[st].append(n)
-        for k in lists:
-            lists[k] = sorted(lists[k], key=str.lower)
-
-        counts = {k: len(v) for k, v in lists.items()}
-        mine = find_status(data["entries"], user)
-        rows.append({"date": d, "counts": counts, "my": mine, "lists": lists, "paused": d in paused_dates})
-    return jsonify({"success": True, "days": rows, "me": user})
+        # liste/conteggi (SOLO due stati) materializzati alla scrittura
+        data = days[d]
+        mine = find_status(data, user)
+        rows.append({"date": d, "counts": data["counts"], "my": mine, "lists": data["lists"], "paused": d in paused_dates})
+    return tag_response(jsonify({"success": True, "days": rows, "me": user}), etag)
+
+@app.get("/dashboard")
+def api_dashboard():
+    """/list + /summary in una sola richiesta e una sola lettura dello storage:
+    ogni riga ha già liste e conteggi, quindi il riepilogo si disegna dalle stesse righe."""
+    user = session.get("user")
+    if not user:
+        return jsonify({"success": False, "error": "Non autenticato"}), 401
+    weeks = max(1, min(52, int(request.args.get("weeks", PM_WEEKS_DEF))))
+    etag = response_etag("dashboard", user, weeks)
+    cached = not_modified(etag)
+    if cached:
+        return cached
+    dates = next_tuesdays(weeks)
+    paused_dates = paused_set()
+    days = read_day_views(dates)
+    rows = []
+    for d in dates:
+        data = days[d]
+        rows.append({"date": d, "counts": data["counts"], "my": find_status(data, user), "lists": data["lists"], "paused": d in paused_dates})
+    return tag_response(jsonify({
+        "success": True,
+        "me": user,
+        "days": rows,
+        "paused_dates": sorted(d for d in paused_dates if d >= dates[0]),
+        "rule": read_rules()["rules"].get(user.lower()),
+    }), etag)
 
 @app.post("/save")
 def api_save():
@@ -208,68 +2263,149 @@ def api_save():
     st = (request.form.get("status") or "").strip().lower()
     if not is_tuesday(d):
         return jsonify({"success": False, "error": "Data non valida (martedì, YYYY-MM-DD)"}), 400
-    if d in set(read_pauses().get("paused_dates", [])):
+    if d in paused_set():
         return jsonify({"success": False, "error": "Martedì in pausa: non è possibile segnare la presenza"}), 409
-    if st not in VALID_STATUSES:
+    if st not in ENTRY_STATUSES:
         return jsonify({"success": False, "error": "Stato non valido"}), 400
-    data = write_day(d, {"name": user, "status": st})
+    data = apply_rules(write_day(d, {"name": user, "status": st}))
+    publish_event({"type": "day", "date": d, "name": user, "status": st, "counts": data["counts"]})
     return jsonify({"success": True, "data": data})
 
+@app.post("/save_batch")
+def api_save_batch():
+    """Più martedì in una richiesta: {"items": [{"date": "...", "status": "..."}]}.
+    Ogni data è validata come /save; quelle valide sono scritte insieme."""
+    user = session.get("user")
+    if not user:
+        return jsonify({"success": False, "error": "Non autenticato"}), 401
+    body = request.get_json(silent=True) or {}
+    items = body.get("items")
+    if not isinstance(items, list) or not items:
+        return jsonify({"success": False, "error": "Nessuna data fornita"}), 400
+    if len(items) > PM_BATCH_MAX:
+        return jsonify({"success": False, "error": f"Massimo {PM_BATCH_MAX} date per richiesta"}), 400
+
+    paused = paused_set()
+    results, todo = [], {}
+    for it in items:
+        it = it if isinstance(it, dict) else {}
+        d = str(it.get("date") or "")
+        st = str(it.get("status") or "").strip().lower()
+        if not is_tuesday(d):
+            results.append({"date": d, "success": False, "error": "Data non valida (martedì, YYYY-MM-DD)"})
+        elif d in paused:
+            results.append({"date": d, "success": False, "error": "Martedì in pausa: non è possibile segnare la presenza"})
+        elif st not in ENTRY_STATUSES:
+            results.append({"date": d, "success": False, "error": "Stato non valido"})
+        else:
+            todo[d] = st  # se una data è ripetuta vale l'ultima
+            results.append({"date": d, "success": True})
+
+    saved = {d: apply_rules(data) for d, data in write_days(user, list(todo.items())).items()} if todo else {}
+    for d, data in saved.items():
+        publish_event({"type": "day", "date": d, "name": user, "status": todo[d], "counts": data["counts"]})
+    for r in results:
+        if r["success"]:
+            data = saved[r["date"]]
+            r.update(status=todo[r["date"]], counts=data["counts"], lists=data["lists"])
+    return jsonify({"success": True, "saved": len(saved), "results": results})
+
+@app.get("/rule")
+def api_rule():
+    user = session.get("user")
+    if not user:
+        return jsonify({"success": False, "error": "Non autenticato"}), 401
+    return jsonify({"success": True, "rule": read_rules()["rules"].get(user.lower())})
+
+@app.post("/rule")
+def api_rule_set():
+    """Imposta (status, every, anchor, until) o rimuove (status vuoto/"none") la regola dell'utente."""
+    user = session.get("user")
+    if not user:
+        return jsonify({"success": False, "error": "Non autenticato"}), 401
+    status = (request.form.get("status") or "").strip().lower()
+    if status in {"", "none"}:
+        rule = None
+        update_rules(lambda rules: rules.pop(user.lower(), None))
+    else:
+        try:
+            rule = normalize_rule(user, request.form)
+        except ValueError as exc:
+            return jsonify({"success": False, "error": str(exc)}), 400
+        update_rules(lambda rules: rules.__setitem__(rule["name"].lower(), rule))
+    publish_event({"type": "reload"})
+    return jsonify({"success": True, "rule": rule})
+
+@app.get("/events")
+def api_events():
+    """Stream SSE delle modifiche: {"type": "day"|"pause"|"reload", ...}."""
+    if not session.get("user"):
+        return jsonify({"success": False, "error": "Non autenticato"}), 401
+    try:
+        q, backlog = events.subscribe(request.headers.get("Last-Event-ID"))
+    except EventBrokerFull:
+        # i thread del worker servono alle altre richieste: il client fa polling
+        return jsonify({"success": False, "error": "Troppi client collegati"}), 503, \
+            {"Retry-After": str(PM_SSE_RETRY)}
+    start_shared_watcher()
+
+    def stream():
+        try:
+            yield "retry: 5000\n\n"
+            for msg in backlog:
+                yield sse_format(msg)
+            while True:
+                try:
+                    msg = q.get(timeout=PM_SSE_PING)
+                except queue.Empty:
+                    yield ": ping\n\n"
+                    continue
+                yield sse_format(msg)
+        finally:
+            events.unsubscribe(q)
+
+    resp = Response(stream_with_context(stream()), mimetype="text/event-stream")
+    resp.call_on_close(lambda: events.unsubscribe(q))  # anche se lo stream non parte mai
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["X-Accel-Buffering"] = "no"
+    return resp
+
 @app.get("/names")
 def api_names():
-    names = {}
-    for fn in os.listdir(PM_DATA_DIR):
-        if not fn.endswith(".json"):
-            continue
-        try:
-            with open(os.path.join(PM_DATA_DIR, fn), "r", encoding="utf-8") as f:
-                data = json.load(f)
-                for e in data.get("entries", []):
-                    n = sanitize_name(e.get("name", ""))
-                    if n:
-                        names[n] = True
-        except Exception:
-            continue
-    return jsonify({"success": True, "data": sorted(names.keys(), key=str.lower)})
+    etag = response_etag("names")
+    cached = not_modified(etag)
+    if cached:
+        return cached
+    return tag_response(jsonify({"success": True, "data": name_index.names()}), etag)
 
 @app.get("/summary")
 def api_summary():
-    weeks = int(request.args.get("weeks", PM_WEEKS_DEF))
-    dates = next_tuesdays(max(1, min(52, weeks)))
-    paused_dates = set(read_pauses().get("paused_dates", []))
+    weeks = max(1, min(52, int(request.args.get("weeks", PM_WEEKS_DEF))))
+    etag = response_etag("summary", weeks)
+    cached = not_modified(etag)
+    if cached:
+        return cached
+    dates = next_tuesdays(weeks)
+    paused_dates = paused_set()
+    days = read_day_views(dates)
     out = []
     for d in dates:
-        data = read_day(d)
-        lists = {"presence": [], "online": []}
-        for e in data.get("entries", []):
-            n = sanitize_name(e.get("name", ""))
-            s = (e.get("status") or "").strip().lower()
-            if n and s in lists:
-                lists[s].append(n)
-        for k in lists:
-            lists[k] = sorted(lists[k], key=str.lower)
+        data = days[d]
         out.append({
             "date": d,
-            "lists": lists,
-            "counts": {k: len(v) for k, v in lists.items()},
+            "lists": data["lists"],
+            "counts": data["counts"],
             "paused": d in paused_dates,
         })
-    return jsonify({"success": True, "days": out})
+    return tag_response(jsonify({"success": True, "days": out}), etag)
 
 
 
 
 from flask import render_template_string, redirect, url_for, send_file
 
-DAY_JSON_RE = re.compile(r"^\d{4}-\d{2}-\d{2}\.json$")
 PAUSE_ARCHIVE_FILE = "_pauses.json"
-
-def list_day_json_files():
-    files = []
-    for fn in os.listdir(PM_DATA_DIR):
-        if DAY_JSON_RE.match(fn):
-            files.append(fn)
-    return sorted(files)
+RULES_ARCHIVE_FILE = "_rules.json"
 
 def normalize_day_payload(dstr: str, payload):
     if not isinstance(payload, dict):
@@ -285,7 +2421,7 @@ def normalize_day_payload(dstr: str, payload):
             continue
         name = sanitize_name(entry.get("name", ""))
         status = (entry.get("status") or "").strip().lower()
-        if not name or status not in VALID_STATUSES:
+        if not name or status not in ENTRY_STATUSES:
             continue
         key = name.lower()
         if key in seen:
@@ -294,67 +2430,368 @@ def normalize_day_payload(dstr: str, payload):
         seen.add(key)
     return {"date": dstr, "entries": normalized, "updated_at": datetime.utcnow().isoformat()}
 
-def build_zip_bytes(days_data: dict, generated_by: str, pauses_data=None):
-    payload = io.BytesIO()
-    with zipfile.ZipFile(payload, mode="w", compression=zipfile.ZIP_DEFLATED) as zf:
+class _ZipSink(io.RawIOBase):
+    """Destinazione write-only e non seekable per zipfile (che allora usa i data
+    descriptor): accumula i byte scritti finché iter_zip_chunks non li svuota."""
+    def __init__(self):
+        self._chunks = []
+        self._pos = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        self._pos += len(b)
+        return len(b)
+
+    def tell(self):
+        return self._pos
+
+    def drain(self) -> bytes:
+        out = b"".join(self._chunks)
+        self._chunks.clear()
+        return out
+
+def iter_zip_chunks(files, day_items, generated_by: str, pauses_data=None, rules_data=None,
+                    generated_at=None, since=None, present=None, version=None):
+    """Genera l'archivio di backup a pezzi, un membro alla volta.
+    `files` sono i nomi per il manifest, `day_items` un iterabile (lazy) di (nome, contenuto):
+    in memoria c'è al più un giorno compresso.
+
+    Con `since` l'archivio è incrementale: contiene solo i giorni (e pause/regole) cambiati
+    dopo quell'istante, e `present` elenca tutti i file giorno esistenti, così il restore
+    sa quali sono stati cancellati. Il manifest va in coda perché porta lo sha256 di ogni membro.
+    `version` è la data_version letta prima di scegliere i giorni (non a fine archivio:
+    un /save fatto mentre si comprime non è nell'archivio e deve finire nel prossimo)."""
+    generated_at = generated_at or datetime.utcnow()
+    sink = _ZipSink()
+    hashes = {}
+
+    def put(fn, content):
+        raw = json.dumps(content, ensure_ascii=False, indent=2).encode("utf-8")
+        hashes[fn] = hashlib.sha256(raw).hexdigest()
+        zf.writestr(fn, raw)
+
+    with zipfile.ZipFile(sink, mode="w", compression=zipfile.ZIP_DEFLATED) as zf:
+        for fn, content in day_items:
+            put(fn, content)
+            yield sink.drain()
+        if pauses_data is not None:
+            put(PAUSE_ARCHIVE_FILE, pauses_data)
+        if rules_data is not None:
+            put(RULES_ARCHIVE_FILE, rules_data)
         manifest = {
-            "generated_at": datetime.utcnow().isoformat(),
+            "generated_at": generated_at.isoformat(),
             "generated_by": generated_by,
-            "files": sorted(days_data.keys()),
-            "has_pauses": bool(pauses_data),
-            "format_version": 1,
+            "kind": "incremental" if since else "full",
+            "since": since.isoformat() if since else None,
+            "data_version": version,
+            "files": sorted(files),
+            "present": sorted(present) if present is not None else None,
+            "hashes": hashes,
+            "has_pauses": pauses_data is not None,
+            "has_rules": bool(rules_data and rules_data.get("rules")),
+            "format_version": 2,
         }
         zf.writestr("manifest.json", json.dumps(manifest, ensure_ascii=False, indent=2))
-        for fn, content in sorted(days_data.items()):
-            zf.writestr(fn, json.dumps(content, ensure_ascii=False, indent=2))
-        if pauses_data:
-            zf.writestr(PAUSE_ARCHIVE_FILE, json.dumps(pauses_data, ensure_ascii=False, indent=2))
-    payload.seek(0)
-    return payload
+    yield sink.drain()
 
-def read_backup_zip(file_storage):
-    raw = file_storage.read()
-    if not raw:
-        raise ValueError("File di backup vuoto")
+def parse_backup_since(raw: str):
+    """`since` di un backup incrementale: il generated_at di un manifest (ISO, UTC)
+    oppure una data_version (intero, ns). ValueError se non è né l'uno né l'altro."""
+    raw = (raw or "").strip()
+    if raw.isdigit():
+        return datetime.utcfromtimestamp(int(raw) / 1e9)
+    try:
+        since = datetime.fromisoformat(raw)
+    except ValueError:
+        raise ValueError("Parametro since non valido (ISO o data_version)")
+    if since.tzinfo is not None:
+        since = since.astimezone(timezone.utc).replace(tzinfo=None)
+    return since
+
+def _updated_after(payload, since: datetime) -> bool:
+    return (payload.get("updated_at") or "") > since.isoformat()
+
+def iter_stored_days(dates):
+    """(nome file, giorno normalizzato) letti uno alla volta dallo storage."""
+    for dstr in dates:
+        yield f"{dstr}.json", normalize_day_payload(dstr, storage.read_day(dstr))
+
+def spool_upload(file_storage):
+    """Si prende il file temporaneo in cui Werkzeug ha già scritto l'upload (vedi
+    _Request) invece di copiarlo: la richiesta, chiudendosi, chiude solo un segnaposto."""
+    spool, file_storage.stream = file_storage.stream, io.BytesIO()
+    size = spool.seek(0, os.SEEK_END)
+    if size > PM_RESTORE_MAX_UPLOAD or not size:
+        spool.close()
+        raise ValueError(f"Backup troppo grande (max {PM_RESTORE_MAX_UPLOAD // (1024 * 1024)} MB)"
+                         if size else "File di backup vuoto")
+    spool.seek(0)
+    return spool
+
+def _read_member(zf, info, budget: list):
+    """Legge un membro decompresso con i limiti per file e totale; `budget` è [byte rimasti].
+    Non si fida di file_size dichiarato: conta i byte davvero decompressi."""
+    if info.file_size > PM_RESTORE_MAX_MEMBER:
+        raise ValueError(f"File troppo grande nel backup: {info.filename}")
+    limit = min(PM_RESTORE_MAX_MEMBER, budget[0])
+    try:
+        with zf.open(info, "r") as f:
+            data = f.read(limit + 1)
+    except (zipfile.BadZipFile, zlib.error, EOFError, NotImplementedError) as exc:
+        raise ValueError(f"Backup non valido: {info.filename} illeggibile") from exc
+    if len(data) > limit:
+        if limit < PM_RESTORE_MAX_MEMBER:
+            raise ValueError("Backup troppo grande una volta decompresso")
+        raise ValueError(f"File troppo grande nel backup: {info.filename}")
+    budget[0] -= len(data)
+    return data
 
+def read_backup_spool(spool, budget: list = None):
+    """Archivio preso da spool_upload -> {"manifest", "days", "pauses", "rules"};
+    pauses/rules sono None se l'archivio non li contiene (per un incrementale: invariati).
+    `budget` ([byte rimasti]) va condiviso tra gli archivi di una catena: restano tutti
+    in memoria fino a combine_backup_chain."""
     try:
-        zf = zipfile.ZipFile(io.BytesIO(raw))
+        zf = zipfile.ZipFile(spool)
     except zipfile.BadZipFile as exc:
         raise ValueError("Backup non valido: file ZIP corrotto") from exc
 
     days = {}
     pauses_data = None
+    rules_data = None
+    manifest = {}
+    if budget is None:
+        budget = [PM_RESTORE_MAX_TOTAL]
     with zf:
-        names = [n for n in zf.namelist() if not n.endswith("/")]
-        for member in names:
-            base = os.path.basename(member)
+        members = [i for i in zf.infolist() if not i.is_dir()]
+        if len(members) > PM_RESTORE_MAX_MEMBERS:
+            raise ValueError(f"Troppi file nel backup (max {PM_RESTORE_MAX_MEMBERS})")
+        for info in members:
+            if os.path.basename(info.filename) == "manifest.json":
+                try:
+                    manifest = json.loads(_read_member(zf, info, budget).decode("utf-8"))
+                except (UnicodeDecodeError, json.JSONDecodeError) as exc:
+                    raise ValueError("JSON non valido nel manifest") from exc
+                if not isinstance(manifest, dict):
+                    raise ValueError("Manifest non valido")
+        hashes = manifest.get("hashes") if isinstance(manifest.get("hashes"), dict) else {}
+
+        def member_json(info, what):
+            raw = _read_member(zf, info, budget)
+            expected = hashes.get(info.filename)
+            if expected and hashlib.sha256(raw).hexdigest() != expected:
+                raise ValueError(f"Backup non valido: hash diverso dal manifest per {info.filename}")
+            try:
+                return json.loads(raw.decode("utf-8"))
+            except (UnicodeDecodeError, json.JSONDecodeError) as exc:
+                raise ValueError(f"JSON non valido nel file {what}") from exc
+
+        for info in members:
+            base = os.path.basename(info.filename)
             if base == PAUSE_ARCHIVE_FILE:
-                with zf.open(member, "r") as f:
-                    try:
-                        payload = json.loads(f.read().decode("utf-8"))
-                    except Exception as exc:
-                        raise ValueError("JSON non valido nel file pause") from exc
+                payload = member_json(info, "pause")
                 paused_dates = payload.get("paused_dates", []) if isinstance(payload, dict) else []
                 pauses_data = {
                     "paused_dates": normalize_paused_dates(paused_dates),
                     "updated_at": datetime.utcnow().isoformat(),
                 }
                 continue
+            if base == RULES_ARCHIVE_FILE:
+                payload = member_json(info, "regole")
+                raw = payload.get("rules", {}) if isinstance(payload, dict) else {}
+                rules_data = {}
+                for r in raw.values() if isinstance(raw, dict) else []:
+                    try:
+                        rule = normalize_rule((r or {}).get("name"), r)
+                    except (ValueError, AttributeError):
+                        continue
+                    rules_data[rule["name"].lower()] = rule
+                continue
             if not DAY_JSON_RE.match(base):
                 continue
-            with zf.open(member, "r") as f:
-                try:
-                    payload = json.loads(f.read().decode("utf-8"))
-                except Exception as exc:
-                    raise ValueError(f"JSON non valido nel file {base}") from exc
+            payload = member_json(info, base)
             day_str = base.replace(".json", "")
             days[base] = normalize_day_payload(day_str, payload)
 
-    if not days and pauses_data is None:
+    incremental = manifest.get("kind") == "incremental"
+    if not days and pauses_data is None and rules_data is None and not incremental:
         raise ValueError("Nessun file giornaliero valido trovato nel backup")
-    if pauses_data is None:
-        pauses_data = {"paused_dates": [], "updated_at": None}
-    return days, pauses_data
+    return {"manifest": manifest, "days": days, "pauses": pauses_data, "rules": rules_data}
+
+def combine_backup_chain(archives):
+    """Unisce una catena full + incrementali (in qualsiasi ordine di upload) in un unico
+    stato (days, pauses, rules, ha_full). Ogni incrementale deve partire da un istante
+    non successivo all'archivio precedente, altrimenti nella catena c'è un buco."""
+    archives = sorted(archives, key=lambda a: a["manifest"].get("generated_at") or "")
+    days, pauses, rules = {}, None, None
+    has_full = False
+    prev_at = None
+    for i, a in enumerate(archives):
+        m = a["manifest"]
+        if m.get("kind") == "incremental":
+            if prev_at is not None and (m.get("since") or "") > prev_at:
+                raise ValueError(f"Catena incompleta: manca un backup tra {prev_at} e {m.get('since')}")
+            if m.get("present") is not None:
+                present = set(m["present"])
+                days = {fn: d for fn, d in days.items() if fn in present}
+        else:
+            if i:
+                raise ValueError("La catena può contenere un solo backup completo, il più vecchio")
+            has_full = True
+            days = {}
+            pauses = {"paused_dates": [], "updated_at": None}
+            rules = {}
+        days.update(a["days"])
+        if a["pauses"] is not None:
+            pauses = a["pauses"]
+        if a["rules"] is not None:
+            rules = a["rules"]
+        prev_at = m.get("generated_at") or prev_at
+    return days, pauses, rules, has_full
+
+def _entry_map(payload):
+    out = {}
+    for e in payload.get("entries", []) if payload else []:
+        name = (e.get("name") or "").strip()
+        if name:
+            out[name.lower()] = (name, (e.get("status") or "").strip().lower())
+    return out
+
+def merge_day_payload(base: dict, incoming: dict):
+    """Merge di un giorno: le entry del backup vincono su quelle correnti con lo stesso nome."""
+    merged_map = {(e.get("name") or "").lower(): e for e in base.get("entries", [])}
+    for e in incoming.get("entries", []):
+        merged_map[(e.get("name") or "").lower()] = e
+    return {
+        "date": incoming["date"],
+        "entries": sorted(merged_map.values(), key=lambda x: (x.get("name") or "").lower()),
+        "updated_at": datetime.utcnow().isoformat(),
+    }
+
+def diff_day(current, target):
+    """Nomi aggiunti/aggiornati/rimossi passando da `current` a `target` (None = file assente).
+    L'ordine delle entry e updated_at non contano."""
+    cur, tgt = _entry_map(current), _entry_map(target)
+    return {
+        "added": sorted(tgt[k][0] for k in tgt.keys() - cur.keys()),
+        "updated": sorted(tgt[k][0] for k in tgt.keys() & cur.keys() if tgt[k] != cur[k]),
+        "removed": sorted(cur[k][0] for k in cur.keys() - tgt.keys()),
+    }
+
+def plan_restore(mode: str, incoming_days: dict, incoming_pauses: dict, incoming_rules, progress=None):
+    """Confronta lo stato corrente con quello risultante dal restore, senza scrivere nulla.
+    {"days": {data: payload | None (da cancellare)}, "pauses"/"rules": payload | None
+    (invariati), "changed": bool, "report": riepilogo per il client}.
+    Nei giorni toccati solo dal merge le entry con stati non più validi restano come sono.
+    Si leggono solo i giorni dell'archivio (più tutti gli esistenti col replace, che
+    cancella quelli assenti dall'archivio)."""
+    incoming = {fn[:-5]: payload for fn, payload in incoming_days.items()}
+    existing = set(storage.day_dates())
+    wanted = sorted(existing if mode == "replace" else existing & incoming.keys())
+    current = {}
+    for i, d in enumerate(wanted, 1):
+        current[d] = storage.read_day(d)
+        if progress:
+            progress(i, len(wanted))
+    if mode == "replace":
+        targets = {d: incoming.get(d) for d in current.keys() | incoming.keys()}
+    else:
+        targets = {
+            d: merge_day_payload(current[d], payload) if d in current else payload
+            for d, payload in incoming.items()
+        }
+
+    days, changes = {}, []
+    totals = {"added": 0, "updated": 0, "removed": 0}
+    files = {"added": 0, "updated": 0, "removed": 0, "unchanged": 0}
+    for d in sorted(targets):
+        target = targets[d]
+        if target is None and d not in current:
+            continue
+        diff = diff_day(current.get(d), target)
+        if d in current and target is not None and not any(diff.values()):
+            files["unchanged"] += 1
+            continue
+        action = "added" if d not in current else ("removed" if target is None else "updated")
+        files[action] += 1
+        for k in totals:
+            totals[k] += len(diff[k])
+        days[d] = target
+        changes.append(dict(diff, file=f"{d}.json", action=action))
+
+    cur_pauses = read_pauses()
+    paused = set(normalize_paused_dates(incoming_pauses.get("paused_dates", [])))
+    if mode == "merge":
+        paused.update(normalize_paused_dates(cur_pauses.get("paused_dates", [])))
+    pauses = None
+    if sorted(paused) != sorted(normalize_paused_dates(cur_pauses.get("paused_dates", []))):
+        pauses = {"paused_dates": sorted(paused), "updated_at": datetime.utcnow().isoformat()}
+
+    cur_rules = read_rules()["rules"]
+    merged_rules = dict(incoming_rules or {}) if mode == "replace" else dict(cur_rules, **(incoming_rules or {}))
+    rules = None
+    if merged_rules != cur_rules:
+        rules = {"rules": merged_rules, "updated_at": datetime.utcnow().isoformat()}
+
+    report = {
+        "files": files,
+        "entries": totals,
+        "changes": changes,
+        "pauses_changed": pauses is not None,
+        "rules_changed": rules is not None,
+    }
+    return {
+        "days": days,
+        "pauses": pauses,
+        "rules": rules,
+        "changed": bool(days) or pauses is not None or rules is not None,
+        "report": report,
+    }
+
+def write_pre_restore(name: str, progress=None):
+    """Snapshot completo dello stato attuale in data/<name>, scritto a pezzi."""
+    sync_shared_state()
+    version = data_version()
+    dates = sorted(storage.day_dates())
+    write_backup_file(os.path.join(PM_DATA_DIR, name), dates, "auto-pre-restore",
+                      read_pauses(), read_rules(), version=version, progress=progress)
+
+def backup_parts(since=None):
+    """(generated_at, data_version, giorni da includere, giorni esistenti, pause, regole)
+    per un backup; con `since` solo ciò che è cambiato dopo (pause/regole None se invariate).
+    generated_at e data_version sono presi prima di scegliere i giorni: ciò che cambia
+    mentre l'archivio viene scritto finisce anche nel prossimo incrementale."""
+    sync_shared_state()
+    generated_at, version = datetime.utcnow(), data_version()
+    present = sorted(storage.day_dates())
+    pauses, rules = read_pauses(), read_rules()
+    if since is None:
+        return generated_at, version, present, present, pauses, rules
+    dates = storage.changed_since(since)
+    pauses = pauses if _updated_after(pauses, since) else None
+    rules = rules if _updated_after(rules, since) else None
+    return generated_at, version, dates, present, pauses, rules
+
+def write_backup_file(path: str, dates, generated_by: str, pauses, rules,
+                      generated_at=None, since=None, present=None, version=None, progress=None):
+    def days():
+        for i, item in enumerate(iter_stored_days(dates), 1):
+            yield item
+            if progress:
+                progress(i, len(dates))
+    size = 0
+    with open(path, "wb") as f:
+        for chunk in iter_zip_chunks(
+            [f"{d}.json" for d in dates], days(), generated_by, pauses, rules,
+            generated_at=generated_at, since=since,
+            present=[f"{d}.json" for d in present] if since else None, version=version,
+        ):
+            f.write(chunk)
+            size += len(chunk)
+    return size
 
 ADMIN_HTML = r"""
 <!doctype html>
@@ -445,9 +2882,12 @@ ADMIN_HTML = r"""
       <div class="sep"></div>
 
       <h3>Backup dati</h3>
-      <p class="muted">Scarica un backup ZIP completo dei JSON correnti.</p>
+      <p class="muted">Scarica un backup ZIP completo dei JSON correnti, oppure solo le modifiche
+        successive a un backup precedente (incollane il <code>generated_at</code> del manifest o la <code>data_version</code>).</p>
       <div class="row" style="gap:8px">
-        <a class="btn" href="/admin/backup/download">Scarica backup</a>
+        <button class="btn" type="button" onclick="prepareBackup(false)">Scarica backup</button>
+        <input id="backup-since" type="text" style="max-width:280px" placeholder="since (es. 2025-01-07T21:00:00)">
+        <button class="btn" type="button" onclick="prepareBackup(true)">Scarica incrementale</button>
         <span id="out-backup" class="muted"></span>
       </div>
 
@@ -456,14 +2896,17 @@ ADMIN_HTML = r"""
       <h3>Ripristina da backup ZIP</h3>
       <p class="muted">
         Modalità <strong>Merge</strong> (consigliata): aggiunge/aggiorna dati dal backup senza cancellare i JSON attuali.<br>
-        Modalità <strong>Replace</strong>: sostituisce completamente i dati correnti con quelli del backup.
+        Modalità <strong>Replace</strong>: sostituisce completamente i dati correnti con quelli del backup.<br>
+        Per una catena seleziona insieme il backup completo e i suoi incrementali.
       </p>
       <form class="row" onsubmit="return restoreBackup(event)">
-        <input id="backup-file" type="file" accept=".zip,application/zip">
+        <input id="backup-file" type="file" accept=".zip,application/zip" multiple>
         <select id="restore-mode" style="padding:10px;border:1px solid #e5e7eb;border-radius:10px">
           <option value="merge">Merge (sicuro)</option>
           <option value="replace">Replace (sostituisce tutto)</option>
         </select>
+        <label class="muted"><input id="restore-dry" type="checkbox" style="width:auto"> solo anteprima</label>
+        <label class="muted"><input id="restore-profile" type="checkbox" style="width:auto"> profila</label>
         <div class="row" style="gap:8px">
           <button class="btn" type="submit">Ripristina backup</button>
           <span id="out-restore" class="muted"></span>
@@ -472,6 +2915,50 @@ ADMIN_HTML = r"""
 
       <div class="sep"></div>
 
+      <h3>Prenotazioni di una persona</h3>
+      <form class="row" onsubmit="return lookupBookings(event)">
+        <input id="lookup-name" type="text" placeholder="Mario Rossi">
+        <div class="row" style="gap:8px">
+          <button class="btn" type="submit">Cerca</button>
+          <span id="out-lookup" class="muted"></span>
+        </div>
+      </form>
+      <div style="overflow:auto">
+        <table class="tbl">
+          <thead>
+            <tr>
+              <th>Data</th>
+              <th>Stato</th>
+            </tr>
+          </thead>
+          <tbody id="lookup-body"></tbody>
+        </table>
+      </div>
+
+      <div class="sep"></div>
+
+      <h3>Profili delle richieste</h3>
+      <p class="muted">Aggiungi <code>?_profile=1</code> (o l'header <code>X-PM-Profile: 1</code>) a una richiesta fatta con questa sessione admin, ad esempio <code>/summary?_profile=1</code>: viene profilata con cProfile. I file <code>.prof</code> si aprono con <code>pstats</code> o snakeviz.</p>
+      <div class="row" style="gap:8px">
+        <button class="btn" onclick="loadProfiles()">Aggiorna elenco</button>
+        <span id="out-profiles" class="muted"></span>
+      </div>
+      <div style="overflow:auto">
+        <table class="tbl">
+          <thead>
+            <tr>
+              <th>Quando</th>
+              <th>Richiesta</th>
+              <th>Durata</th>
+              <th>Scarica</th>
+            </tr>
+          </thead>
+          <tbody id="profiles-body"></tbody>
+        </table>
+      </div>
+
+      <div class="sep"></div>
+
       <h3>Elimina persone specifiche dai JSON</h3>
       <p class="muted">Inserisci uno o più nomi, uno per riga. Verranno rimossi da <em>tutti</em> i martedì presenti nella cartella dati.</p>
       <form class="row" onsubmit="return deleteNames(event)">
@@ -578,36 +3065,133 @@ async function loadPauseDashboard(){
   }
 }
 
+async function lookupBookings(ev){
+  ev.preventDefault();
+  const name = document.getElementById('lookup-name').value.trim();
+  if(!name){ alert('Inserisci un nome'); return false; }
+  const r = await fetch('/admin/bookings?name=' + encodeURIComponent(name));
+  const j = await r.json();
+  const out = document.getElementById('out-lookup');
+  const body = document.getElementById('lookup-body');
+  body.textContent = '';
+  if(!j.success){
+    out.textContent = j.error || 'Errore';
+    out.className = '';
+    return false;
+  }
+  const rule = j.rule ? ` Regola: ${j.rule.status} ogni ${j.rule.every} sett. dal ${j.rule.anchor}.` : '';
+  out.textContent = `${j.bookings.length} martedì.` + rule;
+  out.className = 'ok';
+  j.bookings.forEach(b => {
+    const tr = document.createElement('tr');
+    [b.date, b.status].forEach(v => { const td = document.createElement('td'); td.textContent = v; tr.appendChild(td); });
+    body.appendChild(tr);
+  });
+  return false;
+}
+
+async function loadProfiles(){
+  const r = await fetch('/admin/profiles');
+  const j = await r.json();
+  const out = document.getElementById('out-profiles');
+  const body = document.getElementById('profiles-body');
+  body.textContent = '';
+  if(!j.success){
+    out.textContent = j.error || 'Errore';
+    out.className = '';
+    return;
+  }
+  out.textContent = `${j.profiles.length} profili (massimo ${j.keep}).`;
+  out.className = 'muted';
+  j.profiles.forEach(p => {
+    const tr = document.createElement('tr');
+    [p.created_at.replace('T', ' ').slice(0, 19), p.label, `${p.duration_ms} ms`].forEach(v => {
+      const td = document.createElement('td'); td.textContent = v; tr.appendChild(td);
+    });
+    const td = document.createElement('td');
+    [['.prof', ''], ['testo', '?format=txt']].forEach(([text, qs]) => {
+      const a = document.createElement('a');
+      a.href = `/admin/profiles/${p.id}/download${qs}`;
+      a.textContent = text;
+      a.style.marginRight = '8px';
+      td.appendChild(a);
+    });
+    tr.appendChild(td);
+    body.appendChild(tr);
+  });
+}
+
+// le operazioni lunghe diventano job: si segue /admin/jobs/<id> finché non finiscono
+const JOB_PHASES = {queued: 'In coda…', running: 'In corso…'};
+
+async function followJob(resp, out){
+  const j = await resp.json();
+  if(!j.success){
+    out.textContent = j.error || 'Errore';
+    out.className = '';
+    return null;
+  }
+  let job = j.job;
+  out.className = 'muted';
+  while(job.state === 'queued' || job.state === 'running'){
+    out.textContent = (JOB_PHASES[job.state] || '') + (job.phase ? ` ${job.phase}` : '')
+      + (job.total ? ` ${job.done}/${job.total}` : '') + ' ';
+    if(job.cancellable){
+      const btn = document.createElement('button');
+      btn.className = 'btn';
+      btn.type = 'button';
+      btn.textContent = 'Annulla';
+      btn.onclick = () => fetch(`/admin/jobs/${job.id}/cancel`, {method:'POST'});
+      out.appendChild(btn);
+    }
+    await new Promise(r => setTimeout(r, 700));
+    const p = await (await fetch(`/admin/jobs/${job.id}`)).json();
+    if(!p.success){ out.textContent = p.error || 'Errore'; out.className = ''; return null; }
+    job = p.job;
+  }
+  if(job.state === 'done') return job;
+  out.textContent = job.state === 'cancelled' ? 'Operazione annullata.' : (job.error || 'Errore');
+  out.className = '';
+  return null;
+}
+
+async function prepareBackup(incremental){
+  const out = document.getElementById('out-backup');
+  const fd = new FormData();
+  if(incremental){
+    const since = (document.getElementById('backup-since').value || '').trim();
+    if(!since){ alert('Indica da quando (generated_at o data_version)'); return; }
+    fd.append('since', since);
+  }
+  const job = await followJob(await fetch('/admin/backup/job', {method:'POST', body:fd}), out);
+  if(!job) return;
+  out.textContent = `Backup pronto: ${job.result.files} file, ${Math.ceil(job.result.bytes / 1024)} KB.`;
+  out.className = 'ok';
+  window.location.href = job.download;
+}
+
 async function deleteNames(ev){
   ev.preventDefault();
   const names = document.getElementById('names').value.trim();
   if(!names){ alert('Inserisci almeno un nome'); return false; }
   const fd = new FormData();
   fd.append('names', names);
-  const r = await fetch('/admin/delete_names', {method:'POST', body:fd});
-  const j = await r.json();
   const out = document.getElementById('out-del');
-  if(j.success){
-    out.textContent = `Rimossi ${j.removed} record in ${j.files_touched} file.`;
+  const job = await followJob(await fetch('/admin/delete_names', {method:'POST', body:fd}), out);
+  if(job){
+    out.textContent = `Rimossi ${job.result.removed} record in ${job.result.files_touched} file.`;
     out.className = 'ok';
-  }else{
-    out.textContent = j.error || 'Errore';
-    out.className = '';
   }
   return false;
 }
 
 async function purgeAll(){
   if(!confirm('Confermi la cancellazione di TUTTI i JSON?')) return;
-  const r = await fetch('/admin/purge_all', {method:'POST'});
-  const j = await r.json();
   const out = document.getElementById('out-purge');
-  if(j.success){
-    out.textContent = `Eliminati ${j.deleted_files} file JSON.`;
+  const job = await followJob(await fetch('/admin/purge_all', {method:'POST'}), out);
+  if(job){
+    out.textContent = `Eliminati ${job.result.deleted_files} file JSON.`;
     out.className = 'ok';
-  }else{
-    out.textContent = j.error || 'Errore';
-    out.className = '';
   }
 }
 
@@ -616,23 +3200,31 @@ async function restoreBackup(ev){
   const fileInput = document.getElementById('backup-file');
   const modeInput = document.getElementById('restore-mode');
   const out = document.getElementById('out-restore');
-  const file = fileInput.files?.[0];
-  if(!file){ alert('Seleziona un file ZIP'); return false; }
+  const files = [...(fileInput.files || [])];
+  if(!files.length){ alert('Seleziona un file ZIP'); return false; }
   const mode = modeInput.value || 'merge';
-  if(mode === 'replace' && !confirm('Confermi REPLACE? I dati correnti verranno sostituiti.')){
+  const dry = document.getElementById('restore-dry').checked;
+  if(mode === 'replace' && !dry && !confirm('Confermi REPLACE? I dati correnti verranno sostituiti.')){
     return false;
   }
   const fd = new FormData();
-  fd.append('backup', file);
+  files.forEach(f => fd.append('backup', f));
   fd.append('mode', mode);
-  const r = await fetch('/admin/backup/restore', {method:'POST', body:fd});
-  const j = await r.json();
-  if(j.success){
-    out.textContent = `Ripristino completato (${j.mode}). File importati: ${j.imported_files}. Pause importate: ${j.paused_imported}. Backup di sicurezza: ${j.pre_restore_backup}.`;
+  if(dry) fd.append('dry_run', '1');
+  const profile = document.getElementById('restore-profile').checked ? '?_profile=1' : '';
+  const job = await followJob(await fetch('/admin/backup/restore' + profile, {method:'POST', body:fd}), out);
+  if(!job) return false;
+  if(profile) loadProfiles();
+  const j = job.result;
+  if(j.dry_run){
+    const f = j.diff.files, e = j.diff.entries;
+    out.textContent = `Anteprima (${j.mode}): file nuovi ${f.added}, modificati ${f.updated}, rimossi ${f.removed}, invariati ${f.unchanged}. `
+      + `Prenotazioni +${e.added} ~${e.updated} -${e.removed}.`
+      + (j.diff.pauses_changed ? ' Pause modificate.' : '') + (j.diff.rules_changed ? ' Regole modificate.' : '');
     out.className = 'ok';
   }else{
-    out.textContent = j.error || 'Errore';
-    out.className = '';
+    out.textContent = `Ripristino completato (${j.mode}, ${j.archives} archivi). File importati: ${j.imported_files}. Pause importate: ${j.paused_imported}. File scritti: ${j.written_files}. Backup di sicurezza: ${j.pre_restore_backup || 'non necessario'}.`;
+    out.className = 'ok';
   }
   return false;
 }
@@ -649,6 +3241,7 @@ function clearLocal(){
 }
 
 loadPauseDashboard();
+loadProfiles();
 </script>
 </body>
 </html>
@@ -684,7 +3277,7 @@ def admin_pauses():
         weeks = 52
     weeks = max(1, min(156, weeks))
     future_tuesdays = next_tuesdays(weeks)
-    paused_dates = set(read_pauses().get("paused_dates", []))
+    paused_dates = paused_set()
 
     active_rows = [{"date": d, "paused": d in paused_dates} for d in future_tuesdays]
 
@@ -713,13 +3306,8 @@ def admin_set_pause():
     if not is_tuesday(dstr):
         return jsonify({"success": False, "error": "Data non valida (martedì, YYYY-MM-DD)"}), 400
 
-    current = set(read_pauses().get("paused_dates", []))
-    if paused:
-        current.add(dstr)
-    else:
-        current.discard(dstr)
-
-    saved = write_pauses(sorted(current))
+    saved = set_pause(dstr, paused)
+    publish_event({"type": "pause", "date": dstr, "paused": paused})
     return jsonify({"success": True, "paused_dates": saved.get("paused_dates", [])})
 
 @app.post("/admin/delete_names")
@@ -733,151 +3321,303 @@ def admin_delete_names():
 
     # case-insensitive set
     targets_lower = {t.lower() for t in targets}
-    removed_total = 0
-    files_touched = 0
-
-    for fn in os.listdir(PM_DATA_DIR):
-        if not fn.endswith(".json"):
-            continue
-        p = os.path.join(PM_DATA_DIR, fn)
-        try:
-            with open(p, "r", encoding="utf-8") as f:
-                data = json.load(f)
-        except Exception:
-            continue
-
-        entries = data.get("entries", [])
-        new_entries = []
-        removed_here = 0
-        for e in entries:
-            name = (e.get("name") or "").strip()
-            if name.lower() in targets_lower:
-                removed_here += 1
-            else:
-                new_entries.append(e)
-
-        if removed_here > 0:
-            data["entries"] = new_entries
-            data["updated_at"] = datetime.utcnow().isoformat()
-            with write_lock:
-                with open(p, "w", encoding="utf-8") as f:
-                    json.dump(data, f, ensure_ascii=False, indent=2)
-            removed_total += removed_here
-            files_touched += 1
-
-    return jsonify({"success": True, "removed": removed_total, "files_touched": files_touched})
+    return submit_admin_job("delete_names", delete_names_job, targets_lower)
+
+def delete_names_job(job, targets_lower):
+    # una cancellazione a metà non ha senso: si parte e si arriva in fondo
+    job.commit("cancellazione")
+    dates = name_index.dates_for(targets_lower)
+    removed_total, files_touched = storage.delete_names(targets_lower, progress=job.progress)
+    if targets_lower & read_rules()["rules"].keys():
+        def drop(rules):
+            for k in targets_lower:
+                rules.pop(k, None)
+        update_rules(drop)
+    bump_data_version(days=dates)
+    publish_event({"type": "reload"})
+    return {"removed": removed_total, "files_touched": files_touched}
 
 @app.post("/admin/purge_all")
 def admin_purge_all():
     if not session.get("is_admin"):
         return jsonify({"success": False, "error": "Non autorizzato"}), 401
 
-    deleted = 0
-    for fn in os.listdir(PM_DATA_DIR):
-        if fn.endswith(".json"):
-            try:
-                os.remove(os.path.join(PM_DATA_DIR, fn))
-                deleted += 1
-            except Exception:
-                pass
-    return jsonify({"success": True, "deleted_files": deleted})
+    return submit_admin_job("purge_all", purge_all_job)
+
+def purge_all_job(job):
+    job.commit("cancellazione")
+    deleted = storage.purge(progress=job.progress)
+    refresh_pauses()
+    refresh_rules()
+    bump_data_version(pauses=True, rules=True, reset=True)
+    publish_event({"type": "reload"})
+    return {"deleted_files": deleted}
 
 @app.get("/admin/backup/download")
 def admin_backup_download():
     if not session.get("is_admin"):
         return jsonify({"success": False, "error": "Non autorizzato"}), 401
 
-    days = {}
-    for fn in list_day_json_files():
-        dstr = fn[:-5]
-        days[fn] = normalize_day_payload(dstr, read_day(dstr))
-    pauses = read_pauses()
-
-    archive = build_zip_bytes(days, generated_by="admin", pauses_data=pauses)
-    stamp = datetime.utcnow().strftime("%Y%m%d-%H%M%S")
-    return send_file(
-        archive,
-        mimetype="application/zip",
-        as_attachment=True,
-        download_name=f"backup-presenze-{stamp}.zip",
+    # ?since=<generated_at di un manifest | data_version>: solo ciò che è cambiato dopo
+    since = None
+    if request.args.get("since"):
+        try:
+            since = parse_backup_since(request.args["since"])
+        except ValueError as exc:
+            return jsonify({"success": False, "error": str(exc)}), 400
+
+    generated_at, version, dates, present, pauses, rules = backup_parts(since)
+
+    # niente archivio in memoria: i giorni vengono letti e compressi mentre il client scarica
+    chunks = iter_zip_chunks(
+        [f"{d}.json" for d in dates], iter_stored_days(dates),
+        generated_by="admin", pauses_data=pauses, rules_data=rules,
+        generated_at=generated_at, since=since,
+        present=[f"{d}.json" for d in present] if since else None, version=version,
     )
+    stamp = generated_at.strftime("%Y%m%d-%H%M%S")
+    kind = "incr" if since else "full"
+    resp = Response(stream_with_context(chunk for chunk in chunks if chunk), mimetype="application/zip")
+    resp.headers["Content-Disposition"] = f'attachment; filename="backup-presenze-{kind}-{stamp}.zip"'
+    resp.headers["Cache-Control"] = "no-store"
+    return resp
 
 @app.post("/admin/backup/restore")
 def admin_backup_restore():
     if not session.get("is_admin"):
         return jsonify({"success": False, "error": "Non autorizzato"}), 401
 
-    file_storage = request.files.get("backup")
-    if not file_storage:
+    # il limite va alzato prima di toccare request.files: il controllo su Content-Length
+    # avviene prima del parse; per il limite del singolo archivio c'è spool_upload
+    request.max_content_length = PM_RESTORE_MAX_REQUEST
+    # uno o più archivi: un backup completo seguito dai suoi incrementali
+    uploads = [f for f in request.files.getlist("backup") if f and f.filename]
+    if not uploads:
         return jsonify({"success": False, "error": "File backup mancante"}), 400
+    if len(uploads) > PM_RESTORE_MAX_CHAIN:
+        return jsonify({"success": False, "error": f"Troppi archivi (max {PM_RESTORE_MAX_CHAIN})"}), 400
 
     mode = (request.form.get("mode") or "merge").strip().lower()
     if mode not in {"merge", "replace"}:
         return jsonify({"success": False, "error": "Modalità non valida"}), 400
+    dry_run = (request.form.get("dry_run") or "").strip().lower() in {"1", "true", "on", "yes"}
 
+    # i file dell'upload vanno tolti ora alla richiesta (che li chiude quando finisce);
+    # lettura, confronto e scrittura le fa il job
+    spools = []
     try:
-        incoming_days, incoming_pauses = read_backup_zip(file_storage)
+        for f in uploads:
+            spools.append(spool_upload(f))
     except ValueError as exc:
+        for sp in spools:
+            sp.close()
         return jsonify({"success": False, "error": str(exc)}), 400
 
-    pre_restore_name = f"_pre_restore_{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}.zip"
+    def close_spools():
+        for sp in spools:
+            sp.close()
+
+    return submit_admin_job("restore", restore_job, spools, mode, dry_run, cleanup=close_spools)
+
+def restore_job(job, spools, mode: str, dry_run: bool):
+    archives = []
+    budget = [PM_RESTORE_MAX_TOTAL]  # uno solo per tutta la catena
+    job.progress(0, len(spools), "lettura archivi")
+    for i, sp in enumerate(spools, 1):
+        archives.append(read_backup_spool(sp, budget))
+        job.progress(i)
+    incoming_days, incoming_pauses, incoming_rules, has_full = combine_backup_chain(archives)
+    if mode == "replace" and not has_full:
+        raise ValueError("Replace richiede un backup completo all'inizio della catena")
+    incoming_pauses = incoming_pauses or {"paused_dates": []}
+
+    # diff calcolato fuori da write_lock: i /save continuano mentre si legge e confronta
+    sync_shared_state()
+    version = data_version()
+    plan = plan_restore(mode, incoming_days, incoming_pauses, incoming_rules,
+                        progress=lambda d, t: job.progress(d, t, "confronto"))
+    report = plan["report"]
+    if dry_run:
+        return {"mode": mode, "dry_run": True, "archives": len(archives), "diff": report}
+
+    def safety_backup():
+        name = f"_pre_restore_{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}.zip"
+        write_pre_restore(name, progress=lambda d, t: job.progress(d, t, "backup di sicurezza"))
+        return name
+
+    pre_restore_name = safety_backup() if plan["changed"] else None
+
+    job.commit("scrittura")
+    with write_guard():
+        sync_shared_state()  # la versione locale può non avere le scritture degli altri worker
+        if data_version() != version:
+            # qualcuno ha scritto durante il confronto o il backup di sicurezza: piano e
+            # backup si rifanno qui, sotto il lock, sui dati attuali
+            plan = plan_restore(mode, incoming_days, incoming_pauses, incoming_rules)
+            report = plan["report"]
+            stale = pre_restore_name
+            pre_restore_name = safety_backup() if plan["changed"] else None
+            if stale and stale != pre_restore_name:
+                _remove_quietly(os.path.join(PM_DATA_DIR, stale))
+        total = len(plan["days"])
+        for i, (dstr, payload) in enumerate(plan["days"].items(), 1):
+            if payload is None:
+                storage.delete_day(dstr)
+            else:
+                storage.put_day(dstr, payload)
+            job.progress(i, total)
+        if plan["pauses"] is not None:
+            atomic_write_json(pause_path(), plan["pauses"])
+            refresh_pauses(plan["pauses"])
+        if plan["rules"] is not None:
+            # update_rules prende write_guard: qui lo teniamo già
+            atomic_write_json(rules_path(), plan["rules"])
+            refresh_rules()
+    if plan["changed"]:
+        bump_data_version(days=plan["days"], pauses=plan["pauses"] is not None, rules=plan["rules"] is not None)
+        publish_event({"type": "reload"})
+
+    return {
+        "mode": mode,
+        "dry_run": False,
+        "archives": len(archives),
+        "imported_files": len(incoming_days),
+        "written_files": len(plan["days"]),
+        "paused_imported": len(normalize_paused_dates(incoming_pauses.get("paused_dates", []))),
+        "rules_imported": len(incoming_rules or {}),
+        "diff": report,
+        "pre_restore_backup": pre_restore_name,
+    }
+
+@app.post("/admin/backup/job")
+def admin_backup_job():
+    """Backup (completo o ?since=) preparato in background su file temporaneo."""
+    if not session.get("is_admin"):
+        return jsonify({"success": False, "error": "Non autorizzato"}), 401
+    since = None
+    raw = request.form.get("since") or request.args.get("since")
+    if raw:
+        try:
+            since = parse_backup_since(raw)
+        except ValueError as exc:
+            return jsonify({"success": False, "error": str(exc)}), 400
+    return submit_admin_job("backup", backup_job, since)
+
+def backup_job(job, since):
+    generated_at, version, dates, present, pauses, rules = backup_parts(since)
+    path = job.new_artifact(".zip")
+    size = write_backup_file(path, dates, "admin", pauses, rules, generated_at=generated_at,
+                             since=since, present=present, version=version,
+                             progress=lambda d, t: job.progress(d, t, "compressione"))
+    kind = "incr" if since else "full"
+    return {
+        "files": len(dates),
+        "bytes": size,
+        "kind": "incremental" if since else "full",
+        "filename": f"backup-presenze-{kind}-{generated_at.strftime('%Y%m%d-%H%M%S')}.zip",
+    }
 
-    with write_lock:
-        current_days = {}
-        for fn in list_day_json_files():
-            dstr = fn[:-5]
-            current_days[fn] = normalize_day_payload(dstr, read_day(dstr))
-        current_pauses = read_pauses()
+@app.get("/admin/jobs")
+def admin_jobs():
+    if not session.get("is_admin"):
+        return jsonify({"success": False, "error": "Non autorizzato"}), 401
+    return jsonify({"success": True, "jobs": jobs.recent()})
 
-        pre_restore_zip = build_zip_bytes(current_days, generated_by="auto-pre-restore", pauses_data=current_pauses)
-        with open(os.path.join(PM_DATA_DIR, pre_restore_name), "wb") as f:
-            f.write(pre_restore_zip.getbuffer())
+@app.get("/admin/jobs/<job_id>")
+def admin_job(job_id):
+    if not session.get("is_admin"):
+        return jsonify({"success": False, "error": "Non autorizzato"}), 401
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({"success": False, "error": "Job non trovato"}), 404
+    return jsonify({"success": True, "job": job.as_dict()})
 
-        if mode == "replace":
-            for fn in list_day_json_files():
-                try:
-                    os.remove(os.path.join(PM_DATA_DIR, fn))
-                except Exception:
-                    pass
-            merged_days = incoming_days
-            merged_pauses = {"paused_dates": normalize_paused_dates(incoming_pauses.get("paused_dates", []))}
-        else:
-            merged_days = dict(current_days)
-            for fn, incoming in incoming_days.items():
-                if fn not in merged_days:
-                    merged_days[fn] = incoming
-                    continue
-                base = merged_days[fn]
-                merged_map = {(e.get("name") or "").lower(): e for e in base.get("entries", [])}
-                for e in incoming.get("entries", []):
-                    merged_map[(e.get("name") or "").lower()] = e
-                merged_days[fn] = {
-                    "date": incoming["date"],
-                    "entries": sorted(merged_map.values(), key=lambda x: (x.get("name") or "").lower()),
-                    "updated_at": datetime.utcnow().isoformat(),
-                }
-            merged_pause_set = set(normalize_paused_dates(current_pauses.get("paused_dates", [])))
-            merged_pause_set.update(normalize_paused_dates(incoming_pauses.get("paused_dates", [])))
-            merged_pauses = {"paused_dates": sorted(merged_pause_set)}
-
-        for fn, payload in merged_days.items():
-            with open(os.path.join(PM_DATA_DIR, fn), "w", encoding="utf-8") as f:
-                json.dump(payload, f, ensure_ascii=False, indent=2)
-        pause_payload = {
-            "paused_dates": normalize_paused_dates(merged_pauses.get("paused_dates", [])),
-            "updated_at": datetime.utcnow().isoformat(),
-        }
-        with open(pause_path(), "w", encoding="utf-8") as f:
-            json.dump(pause_payload, f, ensure_ascii=False, indent=2)
+@app.post("/admin/jobs/<job_id>/cancel")
+def admin_job_cancel(job_id):
+    if not session.get("is_admin"):
+        return jsonify({"success": False, "error": "Non autorizzato"}), 401
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({"success": False, "error": "Job non trovato"}), 404
+    if not job.cancel():
+        return jsonify({"success": False, "error": "Il job non può più essere annullato", "job": job.as_dict()}), 409
+    return jsonify({"success": True, "job": job.as_dict()})
+
+@app.get("/admin/jobs/<job_id>/download")
+def admin_job_download(job_id):
+    if not session.get("is_admin"):
+        return jsonify({"success": False, "error": "Non autorizzato"}), 401
+    job = jobs.get(job_id)
+    if job is None or job.state != "done" or not job.artifact or not os.path.exists(job.artifact):
+        return jsonify({"success": False, "error": "Nessun file per questo job"}), 404
+    return send_file(job.artifact, mimetype="application/zip", as_attachment=True,
+                     download_name=job.result["filename"])
+
+@app.get("/admin/cache")
+def admin_cache_stats():
+    if not session.get("is_admin"):
+        return jsonify({"success": False, "error": "Non autorizzato"}), 401
+    with _day_cache_lock:
+        stats = dict(day_cache_stats, size=len(_day_cache), max_size=PM_DAY_CACHE_SIZE)
+    log = storage.log_stats() if isinstance(storage, JsonStorage) else None
+    return jsonify({"success": True, "storage": storage.name, "day_cache": stats, "change_log": log})
 
+@app.get("/admin/profiles")
+def admin_profiles():
+    if not session.get("is_admin"):
+        return jsonify({"success": False, "error": "Non autorizzato"}), 401
+    return jsonify({"success": True, "profiles": list_profiles(), "keep": PM_PROFILE_KEEP})
+
+@app.get("/admin/profiles/<pid>/download")
+def admin_profile_download(pid):
+    """?format=txt: riepilogo pstats per tempo cumulativo; altrimenti il file .prof."""
+    if not session.get("is_admin"):
+        return jsonify({"success": False, "error": "Non autorizzato"}), 401
+    path = os.path.join(profile_dir(), f"{pid}.prof")
+    if not PROFILE_ID_RE.match(pid) or not os.path.exists(path):
+        return jsonify({"success": False, "error": "Profilo non trovato"}), 404
+    if request.args.get("format") == "txt":
+        return Response(profile_text(pid), mimetype="text/plain; charset=utf-8")
+    return send_file(path, mimetype="application/octet-stream", as_attachment=True,
+                     download_name=f"profile-{pid}.prof")
+
+@app.get("/admin/bookings")
+def admin_bookings():
+    """Chi ha prenotato quando: tutte le entry di un nome, dall'indice nomi."""
+    if not session.get("is_admin"):
+        return jsonify({"success": False, "error": "Non autorizzato"}), 401
+    name = sanitize_name(request.args.get("name", ""))
+    if not name:
+        return jsonify({"success": False, "error": "Nome mancante"}), 400
+    key = name.lower()
+    bookings = []
+    for d, data in storage.read_days(name_index.dates_for([key])).items():
+        for e in data["entries"]:
+            if sanitize_name(e.get("name") or "").lower() == key:
+                bookings.append({"date": d, "name": e.get("name"), "status": e.get("status")})
     return jsonify({
         "success": True,
-        "mode": mode,
-        "imported_files": len(incoming_days),
-        "paused_imported": len(normalize_paused_dates(incoming_pauses.get("paused_dates", []))),
-        "pre_restore_backup": pre_restore_name,
+        "name": name,
+        "bookings": bookings,
+        "rule": read_rules()["rules"].get(key),
     })
 
+@app.get("/admin/names")
+def admin_names():
+    if not session.get("is_admin"):
+        return jsonify({"success": False, "error": "Non autorizzato"}), 401
+    return jsonify({"success": True, "names": name_index.info()})
+
+
+@app.cli.command("migrate-sqlite")
+def cli_migrate_sqlite():
+    """Importa data/*.json nel database SQLite (flask --app server migrate-sqlite)."""
+    if isinstance(storage, JsonStorage):
+        storage.compact()
+    target = storage if isinstance(storage, SqliteStorage) else SqliteStorage(sqlite_path())
+    n = migrate_json_to_sqlite(target)
+    print(f"Migrati {n} giorni in {target.path}. Avvia con PM_STORAGE=sqlite per usarlo.")
+
 
 # ================== MAIN ==================
 if __name__ == "__main__":
@@ -0,0 +1,54 @@
+# Change log dello storage json dopo un crash a metà append: la riga troncata in coda
+# non deve portarsi via il /save successivo (né al riavvio né per gli altri worker).
+import json
+import multiprocessing
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DAY = "2026-01-06"
+
+
+def _import_server(workdir: str):
+    os.chdir(workdir)
+    os.environ.pop("PM_MULTIPROCESS", None)
+    os.environ["PM_STORAGE"] = "json"
+    sys.path.insert(0, ROOT)
+    import server
+    return server
+
+
+def _save_after_torn_tail(workdir):
+    server = _import_server(workdir)
+    server.write_day(DAY, {"name": "Prima", "status": "online"})
+    with open(server.change_log_path(), "ab") as f:
+        f.write(b'{"d":"2026-01-06","n":"Tronc')  # crash a metà append
+    server.write_day(DAY, {"name": "Dopo", "status": "presence"})
+    os._exit(0)  # niente compattazione all'uscita: resta tutto nel log
+
+
+def _read_back(workdir, out):
+    server = _import_server(workdir)
+    with open(server.change_log_path(), "rb") as f:
+        lines = f.read().splitlines()
+    entries = {e["name"]: e["status"] for e in server.read_day(DAY)["entries"]}
+    out.put((entries, lines))
+
+
+def test_save_after_torn_tail_survives_restart(tmp_path):
+    ctx = multiprocessing.get_context("spawn")  # un processo per "avvio"
+    (tmp_path / "data").mkdir()
+    writer = ctx.Process(target=_save_after_torn_tail, args=(str(tmp_path),))
+    writer.start()
+    writer.join(60)
+    assert writer.exitcode == 0
+
+    out = ctx.Queue()
+    reader = ctx.Process(target=_read_back, args=(str(tmp_path), out))
+    reader.start()
+    entries, lines = out.get(timeout=60)
+    reader.join(30)
+
+    assert entries == {"Prima": "online", "Dopo": "presence"}
+    # la riga troncata è stata tagliata, non riempita con quella dopo
+    assert [json.loads(line)["n"] for line in lines] == ["Prima", "Dopo"]
@@ -0,0 +1,70 @@
+# Più processi come i worker di gunicorn (PM_MULTIPROCESS=1) sulla stessa cartella dati:
+# nessuna scrittura deve andare persa, né con lo storage json (change log condiviso e
+# compattazione concorrente) né con sqlite.
+import multiprocessing
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATES = ["2026-01-06", "2026-01-13", "2026-01-20", "2026-01-27"]
+PAUSES = ["2026-03-03", "2026-03-10", "2026-03-17", "2026-03-24"]
+WORKERS = 4
+NAMES = 15  # nomi per worker
+
+
+def _import_server(workdir: str, storage: str):
+    os.chdir(workdir)
+    os.environ["PM_MULTIPROCESS"] = "1"
+    os.environ["PM_STORAGE"] = storage
+    sys.path.insert(0, ROOT)
+    import server
+    return server
+
+
+def _writer(workdir, storage, worker, barrier):
+    server = _import_server(workdir, storage)
+    barrier.wait(60)
+    for i in range(NAMES):
+        name = f"w{worker}-{i}"
+        # ogni nome passa da online a presence: vince l'ultima scrittura
+        for status in ("online", "presence"):
+            for d in DATES:
+                server.write_day(d, {"name": name, "status": status})
+        if i % 5 == 0 and storage == "json":
+            server.storage.compact()  # compattazione mentre gli altri scrivono
+    server.set_pause(PAUSES[worker], True)
+
+
+def _reader(workdir, storage, out):
+    server = _import_server(workdir, storage)
+    days = {d: {e["name"]: e["status"] for e in server.read_day(d)["entries"]} for d in DATES}
+    out.put((days, server._load_pauses_file()["paused_dates"]))
+
+
+def _run(ctx, target, *args):
+    p = ctx.Process(target=target, args=args)
+    p.start()
+    return p
+
+
+@pytest.mark.parametrize("storage", ["json", "sqlite"])
+def test_concurrent_workers_lose_no_writes(tmp_path, storage):
+    ctx = multiprocessing.get_context("spawn")  # processi nuovi, come i worker
+    (tmp_path / "data").mkdir()
+    barrier = ctx.Barrier(WORKERS)
+    procs = [_run(ctx, _writer, str(tmp_path), storage, w, barrier) for w in range(WORKERS)]
+    for p in procs:
+        p.join(120)
+        assert p.exitcode == 0
+
+    out = ctx.Queue()
+    reader = _run(ctx, _reader, str(tmp_path), storage, out)
+    days, paused = out.get(timeout=60)
+    reader.join(30)
+
+    expected = {f"w{w}-{i}": "presence" for w in range(WORKERS) for i in range(NAMES)}
+    for d in DATES:
+        assert days[d] == expected, d
+    assert sorted(paused) == PAUSES